@@ -31,5 +31,42 @@ except ImportError:
 	pass
 
 # import any pure python here
-from guppi_source import guppi_source
+# Python blocks are imported on first use, so a flowgraph only loads the
+# dependencies (keras, vispy...) of the blocks it uses
+import importlib
+import sys
+import types
+
+LAZY_BLOCKS = {
+    'guppi_source': 'guppi_source',
+    'guppi_sink': 'guppi_sink',
+    'fb_source': 'fb_source',
+    'fb_sink': 'fb_sink',
+    'keras_train': 'keras_train',
+    'multistream_qt': 'multistream_qt',
+    'spectrometer': 'spectrometer',
+}
+
+class _lazy_module(types.ModuleType):
+    def __getattr__(self, name):
+        if name not in LAZY_BLOCKS:
+            raise AttributeError("module %s has no attribute %s" % (self.__name__, name))
+        module = importlib.import_module('.' + LAZY_BLOCKS[name], self.__name__)
+        block = getattr(module, name)
+        # Replaces the submodule importing it set, so later lookups are direct
+        setattr(self, name, block)
+        return block
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(LAZY_BLOCKS))
+
+try:
+    sys.modules[__name__].__class__ = _lazy_module
+except TypeError:
+    # Python 2 modules can't change class: swap in a lazy copy of this one,
+    # keeping the original alive so its globals are not cleared
+    _module = _lazy_module(__name__, __doc__)
+    _module.__dict__.update(sys.modules[__name__].__dict__)
+    _module._original = sys.modules[__name__]
+    sys.modules[__name__] = _module
 #
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 
+# Copyright 2019 <+YOU OR YOUR COMPANY+>.
+# 
+# This is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+# 
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this software; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street,
+# Boston, MA 02110-1301, USA.
+# 
+
+
+
+import numpy as np
+import pmt
+from gnuradio import gr
+from filterbank import FilterbankWriter, sigproc_header_from_guppi
+from guppi import GuppiRaw, MJD_UNIX_EPOCH
+
+# Tags that set the sigproc header value of the same name
+HEADER_TAGS = ('fch1', 'foff', 'tsamp')
+
+
+class fb_sink(gr.sync_block):
+    """
+    Writes vectors of nchans float32 values, e.g. integrated spectra, as the
+    rows of a sigproc filterbank file.
+
+    The header is made when the first rows arrive. It starts from the first
+    header of the GUPPI raw file template, if given, as spectra of n_fft
+    point FFTs with n_int spectra summed per row. fch1, foff and tsamp
+    (MHz, MHz and seconds) are then taken from tags of the same name on the
+    first rows, and tstart from an rx_time tag. Finally, fch1, foff, tsamp,
+    tstart and source_name are set to the parameters that are not zero or
+    empty.
+
+    Rows are buffered and written in large batches.
+    """
+    def __init__(self, filename, nchans, fch1=0.0, foff=0.0, tsamp=0.0, tstart=0.0,
+                 source_name='', template='', n_fft=1, n_int=1):
+        gr.sync_block.__init__(self,
+            name="fb_sink",
+            in_sig=[(np.float32, nchans)],
+            out_sig=None)
+        self.filename = filename
+        self.nchans = nchans
+        self.header = {}
+        if template:
+            self.header = sigproc_header_from_guppi(GuppiRaw(template).read_first_header(), n_fft, n_int)
+            if self.header['nchans'] != nchans:
+                raise ValueError("fb_sink: template has %d channels, not %d"
+                                 % (self.header['nchans'], nchans))
+        self.params = {'fch1': fch1, 'foff': foff, 'tsamp': tsamp, 'tstart': tstart,
+                       'source_name': source_name}
+        self.writer = None
+
+    def stop(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        return True
+
+    def make_header(self, n):
+        """ Header of the file, from the template, the tags of the first n rows and the parameters """
+        header = dict(self.header)
+        header.update({'nbits': 32, 'nifs': 1, 'nchans': self.nchans})
+        rx_time = None
+        for tag in self.get_tags_in_window(0, 0, n):
+            key = pmt.symbol_to_string(tag.key)
+            if key in HEADER_TAGS:
+                header[key] = pmt.to_double(tag.value)
+            elif key == 'rx_time' and rx_time is None:
+                rx_time = (pmt.to_uint64(pmt.tuple_ref(tag.value, 0)),
+                           pmt.to_double(pmt.tuple_ref(tag.value, 1)), tag.offset)
+        header.update((key, val) for key, val in self.params.items() if val)
+        for key in HEADER_TAGS:
+            if key not in header:
+                raise ValueError("fb_sink: %s is unknown, set it or a template file" % key)
+        if rx_time is not None and not self.params['tstart']:
+            # rx_time is the time of row offset: step back to the first row
+            secs, frac, offset = rx_time
+            frac -= (offset - self.nitems_read(0)) * header['tsamp']
+            header['tstart'] = MJD_UNIX_EPOCH + (secs + frac) / 86400.
+        return header
+
+    def work(self, input_items, output_items):
+        rows = input_items[0]
+        if self.writer is None:
+            self.writer = FilterbankWriter(self.filename, self.make_header(len(rows)))
+        self.writer.write_rows(rows)
+        return len(rows)
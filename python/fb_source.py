@@ -21,58 +21,123 @@
 
 import numpy
 from gnuradio import gr
-#from blimpy import Waterfall
+from filterbank import Filterbank
+from prefetcher import slot_prefetcher
+from utils import rebin_freq
 import numpy as np
 
-def Waterfall(a, b):
-	return None
+
+class window_prefetcher(object):
+    """
+    Reads and rebins filterbank windows ahead of the consumer on a background thread.
+    Window k of the stream is rebinned into slot k % n_slots of a ring of
+    preallocated float32 buffers, so windows come out in order without copies.
+    Windows are time_intervals rows long, starting from window start_window,
+    and the stream wraps around at the end of the file.
+    """
+    def __init__(self, reader, output_size, time_intervals, n_ahead=2, start_window=0):
+        self.reader = reader
+        self.output_size = output_size
+        self.time_intervals = time_intervals
+        self.n_windows = -(-reader.n_ints_in_file // time_intervals)
+        self.start_window = start_window
+        # One slot more than n_ahead for the window the consumer is working on
+        n_slots = n_ahead + 1
+        self.slots = [np.empty((time_intervals, output_size), dtype=np.float32)
+                      for i in range(n_slots)]
+        self.prefetcher = slot_prefetcher(self._load, n_slots, 1, "fb_prefetch")
+
+    def _load(self, seq, slot):
+        start = (self.start_window + seq) % self.n_windows * self.time_intervals
+        data = self.reader.read_rows(start, start + self.time_intervals)
+        return start, rebin_freq(data, self.output_size, out=self.slots[slot][:len(data)])
+
+    def next_window(self):
+        """
+        Wait for the next window of the stream.
+        Returns (start, rows): the file row the window starts at and its
+        (n_rows, output_size) rebinned spectra, valid until the following call.
+        """
+        return self.prefetcher.next()
+
+    def stop(self):
+        self.prefetcher.stop()
+
+
 class fb_source(gr.sync_block):
     """
     Generates vectors from a Filterbank file.
-	You can use the 'Vector to Stream' block to
-	convert this into a stream.
-	TODO: save frequency data into variables
+    You can use the 'Vector to Stream' block to
+    convert this into a stream.
+    The file is memory-mapped and read time_intervals spectra at a time,
+    optionally restricted to f_start to f_stop MHz. Each spectrum is
+    averaged down to output_size frequency bins.
+    With prefetch > 0, that many windows are read and rebinned ahead on a
+    background thread.
+    TODO: save frequency data into variables
     """
-    def __init__(self, filename, output_size, time_intervals):
+    def __init__(self, filename, output_size, time_intervals, f_start=None, f_stop=None, prefetch=2):
         gr.sync_block.__init__(self,
             name="fb_source",
             in_sig=None,
             out_sig=[(numpy.float32, output_size)])
-	self.file_length = None
-	self.filename = filename
-	self.output_size = output_size
-	self.current_time = 0
-	self.time_intervals = time_intervals
-	self.set_data()
-	self.min_freq = self.frequencies[0]
-	self.max_freq = self.frequencies[len(self.frequencies) - 1]
-	self.num_freq = self.data.shape[1] // self.output_size
-	print(self.min_freq, self.max_freq)
-        self.data_generator = self.output_generator()
+        self.filename = filename
+        self.output_size = output_size
+        self.current_time = 0
+        self.time_intervals = time_intervals
+        self.prefetch = prefetch
+        self.prefetcher = None
+        if time_intervals <= 0:
+            raise ValueError("fb_source: time_intervals must be positive, not %d" % time_intervals)
+        self.reader = Filterbank(filename, f_start=f_start, f_stop=f_stop)
+        self.file_length = self.reader.n_ints_in_file
+        if self.file_length == 0:
+            raise ValueError("fb_source: %s has no spectra" % filename)
+        self.frequencies = self.reader.freqs
+        # Rebinned spectra of the current window, and the next row to output
+        self.window = np.empty((time_intervals, output_size), dtype=np.float32)
+        self.rows = self.window[:0]
+        self.row_idx = 0
+        self.min_freq = self.frequencies[0]
+        self.max_freq = self.frequencies[len(self.frequencies) - 1]
+        print(self.min_freq, self.max_freq)
+
+    def start(self):
+        if self.prefetch > 0:
+            if self.current_time >= self.file_length:
+                self.current_time = 0
+            self.prefetcher = window_prefetcher(self.reader, self.output_size, self.time_intervals,
+                                                self.prefetch, self.current_time // self.time_intervals)
+        return True
+
+    def stop(self):
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+        return True
 
     def work(self, input_items, output_items):
         out = output_items[0]
-	try:
-            out[:] = next(self.data_generator)
-	except StopIteration:
-	    print('getting new data...')
-	    if self.current_time > self.file_length:
-		self.current_time = 0
-	    self.set_data()
-	    self.data_generator = self.output_generator()
-	    out[:] = next(self.data_generator)
-        return len(output_items[0])
-
-    def output_generator(self):
-	for row in self.data:
-	    row = np.nanmean(np.pad(row.astype(float), (0, (self.num_freq - row.size%self.num_freq) %self.num_freq), mode='constant', constant_values=np.NaN).reshape(-1, self.num_freq), axis=1)
-	    yield row[:self.output_size] # this slices off the last values; potential need to fix this by averaging whatever's left & appending
+        n_out = 0
+        while n_out < len(out):
+            if self.row_idx >= len(self.rows):
+                self.set_data()
+                if not len(self.rows):
+                    break
+            n = min(len(out) - n_out, len(self.rows) - self.row_idx)
+            out[n_out:n_out + n] = self.rows[self.row_idx:self.row_idx + n]
+            self.row_idx += n
+            n_out += n
+        return n_out
 
     def set_data(self):
-	print('time: ' + str(self.current_time))
-	self.signals = Waterfall(self.filename, t_start=self.current_time, t_stop=(self.current_time + self.time_intervals))
-	if not self.file_length:
-	    self.file_length = self.signals.n_ints_in_file
-	self.frequencies, self.data = self.signals.grab_data()
-	self.current_time += self.time_intervals
-	
+        if self.prefetcher is not None:
+            self.current_time, self.rows = self.prefetcher.next_window()
+        else:
+            if self.current_time >= self.file_length:
+                self.current_time = 0
+            # A view of the memory-mapped file: rows are only read when rebinned
+            data = self.reader.read_rows(self.current_time, self.current_time + self.time_intervals)
+            self.rows = rebin_freq(data, self.output_size, out=self.window[:len(data)])
+        self.current_time += len(self.rows)
+        self.row_idx = 0
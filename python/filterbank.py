@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+"""
+# filterbank.py
+
+A python file handler for sigproc filterbank (.fil) files, and for
+filterbank data stored in HDF5 (.h5) files as written by blimpy.
+
+A .fil file consists of a binary header, delimited by HEADER_START and
+HEADER_END keywords, followed by the spectra as a (n_ints, n_ifs, n_chans)
+array. The header is parsed once and the data section is memory-mapped, so
+any spectrum row can be read without loading the file into memory.
+
+FilterbankWriter writes .fil files, buffering rows so that spectra are
+written in large batches rather than one row at a time.
+"""
+
+import numpy as np
+import os
+import struct
+import sys
+
+PYTHON3 = sys.version_info >= (3, 0)
+
+###
+# Config values
+###
+
+# Value types of the sigproc header keywords: struct format, or 'str' for strings
+SIGPROC_HEADER_TYPES = {
+    'telescope_id': '<i', 'machine_id': '<i', 'data_type': '<i',
+    'barycentric': '<i', 'pulsarcentric': '<i', 'nbits': '<i',
+    'nsamples': '<i', 'nchans': '<i', 'nifs': '<i', 'nbeams': '<i',
+    'ibeam': '<i', 'tstart': '<d', 'tsamp': '<d', 'fch1': '<d',
+    'foff': '<d', 'refdm': '<d', 'az_start': '<d', 'za_start': '<d',
+    'src_raj': '<d', 'src_dej': '<d', 'period': '<d', 'signed': '<b',
+    'source_name': 'str', 'rawdatafile': 'str',
+}
+
+# Data types of the spectra for each value of nbits
+SIGPROC_DATA_TYPES = {8: np.uint8, 16: np.uint16, 32: np.float32}
+
+# Sigproc telescope_id of GUPPI TELESCOP values
+SIGPROC_TELESCOPE_IDS = {'PARKES': 4, 'PKS': 4, 'GBT': 6}
+
+WRITE_BUFFER_SIZE = 16 * 1024 * 1024  # Bytes of spectra FilterbankWriter buffers between writes
+
+
+def read_sigproc_string(file_obj):
+    """ Read a sigproc string: an int32 length followed by that many characters """
+    n = struct.unpack('<i', file_obj.read(4))[0]
+    if not 0 < n < 256:
+        raise ValueError("read_sigproc_string: invalid string length %d" % n)
+    string = file_obj.read(n)
+    if PYTHON3:
+        string = string.decode("utf-8")
+    return string
+
+
+def read_sigproc_header(file_obj):
+    """ Read the header of a sigproc filterbank file
+
+    Returns:
+        (header, data_idx) - a dictionary of keyword:value header data and
+        the byte index of where the data section starts.
+    """
+    file_obj.seek(0)
+    if read_sigproc_string(file_obj) != 'HEADER_START':
+        raise ValueError("read_sigproc_header: not a sigproc filterbank file")
+
+    header = {}
+    while True:
+        key = read_sigproc_string(file_obj)
+        if key == 'HEADER_END':
+            break
+        if key not in SIGPROC_HEADER_TYPES:
+            raise ValueError("read_sigproc_header: unknown keyword %s" % key)
+        fmt = SIGPROC_HEADER_TYPES[key]
+        if fmt == 'str':
+            header[key] = read_sigproc_string(file_obj)
+        else:
+            header[key] = struct.unpack(fmt, file_obj.read(struct.calcsize(fmt)))[0]
+    return header, file_obj.tell()
+
+
+def write_sigproc_string(file_obj, string):
+    """ Write a sigproc string: an int32 length followed by the characters """
+    if PYTHON3:
+        string = string.encode("utf-8")
+    file_obj.write(struct.pack('<i', len(string)) + string)
+
+
+def write_sigproc_header(file_obj, header):
+    """ Write the header of a sigproc filterbank file
+
+    Args:
+        file_obj: file to write to, at the current position
+        header (dict): keyword:value header data; keywords must be in SIGPROC_HEADER_TYPES
+    """
+    write_sigproc_string(file_obj, 'HEADER_START')
+    for key in sorted(header):
+        if key not in SIGPROC_HEADER_TYPES:
+            raise ValueError("write_sigproc_header: unknown keyword %s" % key)
+        write_sigproc_string(file_obj, key)
+        fmt = SIGPROC_HEADER_TYPES[key]
+        if fmt == 'str':
+            write_sigproc_string(file_obj, str(header[key]))
+        else:
+            file_obj.write(struct.pack(fmt, header[key]))
+    write_sigproc_string(file_obj, 'HEADER_END')
+
+
+def sigproc_angle(angle):
+    """ Convert a 'dd:mm:ss.s' angle string, as in GUPPI RA_STR and DEC_STR, to sigproc ddmmss.s """
+    sign = -1 if angle.strip().startswith('-') else 1
+    d, m, s = [abs(float(x)) for x in angle.split(':')]
+    return sign * (d * 10000 + m * 100 + s)
+
+
+def sigproc_header_from_guppi(header, n_fft=1, n_int=1):
+    """ Sigproc header of the spectra of GUPPI raw data
+
+    Args:
+        header (dict): GUPPI raw header of the first block
+        n_fft (int): length of the FFT, i.e. fine channels per coarse channel
+        n_int (int): number of spectra summed into each row
+
+    Returns:
+        header (dict): sigproc header of float32 Stokes I rows
+
+    Notes: the fine channels of each coarse channel are taken to be in
+    FFT-shifted order, so frequencies follow the sign of CHAN_BW like the
+    coarse channels do.
+    """
+    n_chan = int(header['OBSNCHAN'])
+    chan_bw = float(header.get('CHAN_BW', float(header['OBSBW']) / n_chan))
+    foff = chan_bw / n_fft
+    fch1 = float(header['OBSFREQ']) - (n_chan - 1) / 2. * chan_bw - (n_fft // 2) * foff
+    fb_header = {'nbits': 32, 'nifs': 1, 'nchans': n_chan * n_fft, 'data_type': 1,
+                 'fch1': fch1, 'foff': foff, 'tsamp': float(header['TBIN']) * n_fft * n_int}
+    if 'STT_IMJD' in header:
+        secs = int(header.get('STT_SMJD', 0)) + float(header.get('STT_OFFS', 0.0))
+        fb_header['tstart'] = int(header['STT_IMJD']) + secs / 86400.
+    if 'SRC_NAME' in header:
+        fb_header['source_name'] = str(header['SRC_NAME'])
+    if 'RA_STR' in header and 'DEC_STR' in header:
+        fb_header['src_raj'] = sigproc_angle(str(header['RA_STR']))
+        fb_header['src_dej'] = sigproc_angle(str(header['DEC_STR']))
+    telescope = str(header.get('TELESCOP', '')).upper()
+    if telescope in SIGPROC_TELESCOPE_IDS:
+        fb_header['telescope_id'] = SIGPROC_TELESCOPE_IDS[telescope]
+    return fb_header
+
+
+class Filterbank(object):
+    """ Python class for reading filterbank files
+
+    Args:
+        filename (str): name of the .fil or .h5 file to open
+
+    Optional args:
+        f_start (float): lowest frequency to read, in MHz
+        f_stop (float): highest frequency to read, in MHz
+    """
+
+    def __init__(self, filename, f_start=None, f_stop=None):
+        self.filename = filename
+        self._h5 = None
+        if filename.endswith('.h5'):
+            self.header, self.data = self._open_h5(filename)
+        else:
+            self.header, self.data = self._open_fil(filename)
+        self.n_ints_in_file = self.data.shape[0]
+
+        n_chans = int(self.header['nchans'])
+        all_freqs = self.header['fch1'] + self.header['foff'] * np.arange(n_chans)
+        self.chan_start, self.chan_stop = 0, n_chans
+        if f_start is not None or f_stop is not None:
+            f_lo = -np.inf if f_start is None else f_start
+            f_hi = np.inf if f_stop is None else f_stop
+            selected = np.flatnonzero((all_freqs >= f_lo) & (all_freqs <= f_hi))
+            if not len(selected):
+                raise ValueError("Filterbank: no channels between %s and %s MHz" % (f_start, f_stop))
+            self.chan_start, self.chan_stop = int(selected[0]), int(selected[-1]) + 1
+        self.freqs = all_freqs[self.chan_start:self.chan_stop]
+        self.n_chans = len(self.freqs)
+
+    def __repr__(self):
+        return "<Filterbank file handler for %s>" % self.filename
+
+    def _open_fil(self, filename):
+        with open(filename, 'rb') as file_obj:
+            header, data_idx = read_sigproc_header(file_obj)
+        n_bits = int(header['nbits'])
+        if n_bits not in SIGPROC_DATA_TYPES:
+            raise ValueError("Filterbank: %d-bit data is not supported" % n_bits)
+        dtype = SIGPROC_DATA_TYPES[n_bits]
+        if n_bits == 8 and header.get('signed', 0):
+            dtype = np.int8
+        n_ifs = int(header.get('nifs', 1))
+        n_chans = int(header['nchans'])
+        n_ints = (os.path.getsize(filename) - data_idx) // (n_ifs * n_chans * n_bits // 8)
+        data = np.memmap(filename, dtype=dtype, mode='r', offset=data_idx,
+                         shape=(n_ints, n_ifs, n_chans))
+        return header, data
+
+    def _open_h5(self, filename):
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError("Filterbank: h5py is needed to read .h5 files")
+        self._h5 = h5py.File(filename, 'r')
+        data = self._h5['data']
+        header = {}
+        for key, val in data.attrs.items():
+            if isinstance(val, bytes):
+                val = val.decode("utf-8")
+            header[key] = val
+        return header, data
+
+    def read_rows(self, start, stop, if_idx=0):
+        """ Read spectra start to stop (exclusive) in the selected frequency range
+
+        Returns:
+            data (np.array): (n_rows, n_chans) spectra; a view of the memory map for .fil files
+        """
+        return self.data[start:stop, if_idx, self.chan_start:self.chan_stop]
+
+    def read_row(self, row, if_idx=0):
+        """ Read a single spectrum in the selected frequency range """
+        return self.data[row, if_idx, self.chan_start:self.chan_stop]
+
+    def grab_data(self, t_start=0, t_stop=None, if_idx=0):
+        """ Frequencies and spectra of integrations t_start to t_stop, as blimpy's Waterfall.grab_data
+
+        Returns:
+            (freqs, data) - frequencies in MHz and (n_rows, n_chans) spectra
+        """
+        if t_stop is None:
+            t_stop = self.n_ints_in_file
+        return self.freqs, self.read_rows(t_start, t_stop, if_idx)
+
+    def close(self):
+        if self._h5 is not None:
+            self._h5.close()
+            self._h5 = None
+
+
+class FilterbankWriter(object):
+    """ Python class for writing sigproc filterbank files
+
+    Rows are gathered in a preallocated buffer of about buffer_size bytes,
+    and written in one call whenever it fills up; batches of rows at least
+    that large are written straight from the caller's array.
+
+    Args:
+        filename (str): name of the .fil file to write
+        header (dict): sigproc header; nchans is required, nbits defaults to 32
+                       and nifs to 1
+
+    Optional args:
+        buffer_size (int): number of bytes of rows to buffer between writes
+    """
+
+    def __init__(self, filename, header, buffer_size=WRITE_BUFFER_SIZE):
+        self.filename = filename
+        self.header = dict(header)
+        self.header.setdefault('nbits', 32)
+        self.header.setdefault('nifs', 1)
+        n_bits = int(self.header['nbits'])
+        if n_bits not in SIGPROC_DATA_TYPES:
+            raise ValueError("FilterbankWriter: %d-bit data is not supported" % n_bits)
+        self.dtype = SIGPROC_DATA_TYPES[n_bits]
+        if n_bits == 8 and self.header.get('signed', 0):
+            self.dtype = np.int8
+        self.row_size = int(self.header['nifs']) * int(self.header['nchans'])
+        self.n_buffer_rows = max(1, buffer_size // (self.row_size * n_bits // 8))
+        self.buffer = np.zeros((self.n_buffer_rows, self.row_size), dtype=self.dtype)
+        self.n_buffered = 0
+        self.n_rows = 0
+        self.file_obj = open(filename, 'wb')
+        write_sigproc_header(self.file_obj, self.header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return "<FilterbankWriter file handler for %s>" % self.filename
+
+    def write_rows(self, rows):
+        """ Write spectra
+
+        Args:
+            rows (np.array): (n_rows, n_ifs * n_chans) or (n_rows, n_ifs, n_chans) spectra
+        """
+        rows = rows.reshape(-1, self.row_size)
+        n = len(rows)
+        i = 0
+        if not self.n_buffered and n >= self.n_buffer_rows and rows.dtype == self.dtype:
+            rows = np.ascontiguousarray(rows)
+            rows.tofile(self.file_obj)
+            i = n
+        while i < n:
+            k = min(n - i, self.n_buffer_rows - self.n_buffered)
+            self.buffer[self.n_buffered:self.n_buffered + k] = rows[i:i + k]
+            self.n_buffered += k
+            i += k
+            if self.n_buffered == self.n_buffer_rows:
+                self.flush()
+        self.n_rows += n
+
+    def flush(self):
+        """ Write out the buffered rows """
+        if self.n_buffered:
+            self.buffer[:self.n_buffered].tofile(self.file_obj)
+            self.n_buffered = 0
+        self.file_obj.flush()
+
+    def close(self):
+        if not self.file_obj.closed:
+            self.flush()
+            self.file_obj.close()
@@ -10,9 +10,11 @@ and repeated over and over until the end of the file.
 
 import numpy as np
 import os
+import re
+import json
 import time
 from pprint import pprint
-from utils import unpack, rebin
+from utils import unpack, rebin, to_complex64
 import sys
 
 PYTHON3 = sys.version_info >= (3, 0)
@@ -39,12 +41,281 @@ PYTHON3 = sys.version_info >= (3, 0)
 MAX_PLT_POINTS = 65536 * 4  # Max number of points in matplotlib plot
 MAX_IMSHOW_POINTS = (8192, 4096)  # Max number of points in imshow plot
 MAX_DATA_ARRAY_SIZE = 1024 * 1024 * 1024  # Max size of data array to load into memory
+MJD_UNIX_EPOCH = 40587  # MJD of 1970-01-01
+INDEX_SUFFIX = '.idx.npz'  # Sidecar file holding the block index of a .raw file
+
+# Files of a multi-file scan are named <prefix>.0000.raw, <prefix>.0001.raw, ...
+RAW_SEQUENCE_RE = re.compile(r'^(.*)\.(\d{4})\.raw$')
+
+# One entry per data block of a multi-file scan
+SEQUENCE_INDEX_DTYPE = np.dtype([('file_idx', 'int32'),  # file the block is in
+                                 ('block_idx', 'int64'),  # block number within that file
+                                 ('pktidx', 'int64')])  # PKTIDX of the block, -1 if absent
+
+# One entry per data block in the file
+BLOCK_INDEX_DTYPE = np.dtype([('header_idx', 'int64'),  # byte offset of the header
+                              ('data_idx', 'int64'),  # byte offset of the data
+                              ('blocsize', 'int64'),  # data block size in bytes
+                              ('pktidx', 'int64')])  # PKTIDX of the block, -1 if absent
+
+
+HEADER_READ_SIZE = 80 * 256  # Bytes read per attempt to find the END card of a header
+
+END_CARD_KEY = b'END     '  # 8-char keyword field of the card that ends a header
+DIRECTIO_ALIGN = 512  # Headers of DIRECTIO files are padded to a multiple of this many bytes
+MAX_CARD_CACHE_SIZE = 65536  # Max number of parsed header cards kept for reuse
+
+# Types of known GUPPI header keywords; unknown keywords are typed from their value
+GUPPI_HEADER_TYPES = {
+    'BLOCSIZE': int, 'OBSNCHAN': int, 'NPOL': int, 'NBITS': int, 'PKTIDX': int,
+    'PKTSIZE': int, 'PKTSTART': int, 'PKTSTOP': int, 'NPKT': int, 'NDROP': int,
+    'DIRECTIO': int, 'CHANMAJ': int, 'OVERLAP': int, 'STT_IMJD': int,
+    'STT_SMJD': int, 'SCANNUM': int, 'DS_TIME': int, 'DS_FREQ': int,
+    'OBSFREQ': float, 'OBSBW': float, 'CHAN_BW': float, 'TBIN': float,
+    'STT_OFFS': float, 'SCANLEN': float, 'RA': float, 'DEC': float,
+    'AZ': float, 'ZA': float, 'LST': float, 'BMAJ': float, 'BMIN': float,
+    'BACKEND': str, 'TELESCOP': str, 'OBSERVER': str, 'SRC_NAME': str,
+    'PROJID': str, 'FRONTEND': str, 'FD_POLN': str, 'TRK_MODE': str,
+    'OBS_MODE': str, 'POL_TYPE': str, 'RA_STR': str, 'DEC_STR': str,
+    'DATADIR': str, 'DAQCTRL': str,
+}
 
 
 class EndOfFileError(Exception):
     pass
 
 
+def parse_header_value(key, val):
+    """ Convert the value string of a header card to the type of its keyword
+
+    Args:
+        key (str): header keyword
+        val (str): raw value, i.e. everything after the '=' of the card
+
+    Returns:
+        val (str, int or float): typed value
+    """
+    val = val.strip()
+    val_type = GUPPI_HEADER_TYPES.get(key)
+    if "'" in val or val_type is str:
+        # Items in quotes are strings
+        return str(val.strip("'").strip())
+    if val_type is int:
+        try:
+            return int(val)
+        except ValueError:
+            return int(float(val))
+    if val_type is float or "." in val:
+        # Items with periods are floats (if not a string)
+        return float(val)
+    # Otherwise it's an integer
+    return int(val)
+
+
+def block_n_samples(header):
+    """ Number of time samples in a data block """
+    n_pol = int(header['NPOL'])
+    if n_pol == 2:
+        n_pol = 4
+    return int(header['BLOCSIZE']) * 8 // (int(header['OBSNCHAN']) * n_pol * int(header['NBITS']))
+
+
+def pktidx_step(pktidx, headers):
+    """ PKTIDX increment from one block to the next
+
+    Taken from PIPERBLK if present, otherwise the median step; 0 if unknown.
+    """
+    step = int(headers[0].get('PIPERBLK', 0)) if headers else 0
+    if not step and len(pktidx) > 1 and (pktidx >= 0).all():
+        step = int(np.median(np.diff(pktidx)))
+    return step
+
+
+def block_sample_offsets(pktidx, headers):
+    """ Number of the first time sample of every block, counted from the first block
+
+    Derived from PKTIDX where possible, so that dropped blocks leave a gap
+    in the sample numbers; otherwise the block lengths are summed.
+
+    Args:
+        pktidx (np.array): PKTIDX of every block, from the block index
+        headers (list): header of every block
+
+    Returns:
+        offsets (np.array): int64 sample number of every block
+    """
+    n_samples = np.array([block_n_samples(h) for h in headers], dtype='int64')
+    step = pktidx_step(pktidx, headers)
+    if step > 0 and (pktidx >= 0).all():
+        return (pktidx - pktidx[0]) * n_samples[0] // step
+    return np.concatenate([[0], np.cumsum(n_samples[:-1])]).astype('int64')
+
+
+def block_start_times(pktidx, headers):
+    """ Time of the first sample of every block, from STT_IMJD, STT_SMJD, STT_OFFS and TBIN
+
+    STT_* is taken as the time of PKTSTART if present, otherwise of the first block.
+
+    Args:
+        pktidx (np.array): PKTIDX of every block, from the block index
+        headers (list): header of every block
+
+    Returns:
+        (secs, frac_secs) - int64 whole seconds since the unix epoch and float64
+        fractional seconds of every block, or (None, None) if STT_* is missing.
+        Kept apart so that sample-level precision survives the large epoch offset.
+    """
+    header = headers[0]
+    if 'STT_IMJD' not in header or 'TBIN' not in header:
+        return None, None
+    secs = (int(header['STT_IMJD']) - MJD_UNIX_EPOCH) * 86400 + int(header.get('STT_SMJD', 0))
+    samples = block_sample_offsets(pktidx, headers)
+    step = pktidx_step(pktidx, headers)
+    if 'PKTSTART' in header and step > 0 and pktidx[0] >= 0:
+        samples = samples + (pktidx[0] - int(header['PKTSTART'])) * block_n_samples(header) // step
+    elapsed = float(header.get('STT_OFFS', 0.0)) + samples * float(header['TBIN'])
+    whole = np.floor(elapsed)
+    return (secs + whole).astype('int64'), elapsed - whole
+
+
+def channel_frequencies(header):
+    """ Center frequency of every coarse channel in Hz, from OBSFREQ, OBSBW and CHAN_BW """
+    n_chan = int(header['OBSNCHAN'])
+    chan_bw = float(header.get('CHAN_BW', float(header['OBSBW']) / n_chan))
+    return (float(header['OBSFREQ']) + (np.arange(n_chan) - (n_chan - 1) / 2.) * chan_bw) * 1e6
+
+
+def chan_range(chan, nchan):
+    """ Channel selection for nchan channels from chan; all channels if chan < 0 """
+    if chan < 0:
+        return None
+    return slice(chan, chan + nchan)
+
+
+def channel_selection(chans, n_chan):
+    """ Normalise a channel selection for indexing the channel axis of a block
+
+    Args:
+        chans (None, int, slice or list): selected channels, all if None
+        n_chan (int): number of channels in the block
+
+    Returns:
+        selection (slice or np.array): a slice if the channels are consecutive,
+                                       otherwise an array of channel numbers
+
+    Raises ValueError if any selected channel is not in the block, rather
+    than letting NumPy silently clip the selection.
+    """
+    if chans is None:
+        return slice(0, n_chan)
+    if isinstance(chans, slice):
+        start = 0 if chans.start is None else chans.start
+        stop = n_chan if chans.stop is None else chans.stop
+        if start < 0 or stop > n_chan:
+            raise ValueError("channel_selection: channels %d to %d are not all in the %d channels of the block"
+                             % (start, stop - 1, n_chan))
+        return chans
+    chans = np.atleast_1d(np.asarray(chans, dtype=np.intp))
+    if len(chans) and (chans.min() < 0 or chans.max() >= n_chan):
+        raise ValueError("channel_selection: channels %s are not all in the %d channels of the block"
+                         % (chans.tolist(), n_chan))
+    if len(chans) and (np.diff(chans) == 1).all():
+        return slice(int(chans[0]), int(chans[-1]) + 1)
+    return chans
+
+
+def channel_subset_header(header, chans):
+    """ Header of a block cut down to the coarse channels chans
+
+    OBSNCHAN and BLOCSIZE are updated, and OBSFREQ, OBSBW and SCHAN if
+    present; the channels have to be consecutive for these to describe them.
+
+    Args:
+        header (dict): header of the full block
+        chans (None, int, slice or list): selected channels, all if None
+
+    Returns:
+        header (dict): a new header for the selected channels
+    """
+    n_chan = int(header['OBSNCHAN'])
+    selection = channel_selection(chans, n_chan)
+    if not isinstance(selection, slice) or selection.indices(n_chan)[2] != 1:
+        raise ValueError("channel_subset_header: channels must be consecutive")
+    start, stop, step = selection.indices(n_chan)
+    if stop <= start:
+        raise ValueError("channel_subset_header: no channels selected")
+    n_sel = stop - start
+    header = dict(header)
+    if 'OBSFREQ' in header and 'OBSBW' in header:
+        chan_bw = float(header.get('CHAN_BW', float(header['OBSBW']) / n_chan))
+        header['OBSFREQ'] = float(header['OBSFREQ']) + ((start + stop - 1) / 2. - (n_chan - 1) / 2.) * chan_bw
+        header['OBSBW'] = float(header['OBSBW']) * n_sel / n_chan
+    header['BLOCSIZE'] = int(header['BLOCSIZE']) // n_chan * n_sel
+    header['OBSNCHAN'] = n_sel
+    if 'SCHAN' in header:
+        header['SCHAN'] = int(header['SCHAN']) + start
+    return header
+
+
+_card_cache = {}
+
+
+def parse_header_card(card):
+    """ Parse one 80-byte header card into its (keyword, value) pair
+
+    Most cards repeat verbatim from block to block, so parsed cards are cached.
+    """
+    key_val = _card_cache.get(card)
+    if key_val is None:
+        line = card.decode("utf-8") if PYTHON3 else card
+        key, _, val = line.partition('=')
+        key = key.strip()
+        key_val = (key, parse_header_value(key, val))
+        if len(_card_cache) >= MAX_CARD_CACHE_SIZE:
+            _card_cache.clear()
+        _card_cache[card] = key_val
+    return key_val
+
+
+def format_header_card(key, val):
+    """ Format a (keyword, value) pair as an 80-byte header card
+
+    Strings are quoted and numbers right-aligned as in FITS; floats always
+    keep a decimal point so that parse_header_value reads them back as floats.
+    """
+    if len(key) > 8:
+        raise ValueError("format_header_card: keyword %s is longer than 8 characters" % key)
+    if isinstance(val, (bool, np.bool_)):
+        val = int(val)
+    if isinstance(val, (int, np.integer)):
+        val = '%20d' % val
+    elif isinstance(val, (float, np.floating)):
+        val = repr(float(val))
+        if '.' not in val:
+            val = '%.15E' % float(val)
+        val = '%20s' % val
+    else:
+        val = "'%-8s'" % val
+    card = '%-8s= %s' % (key, val)
+    if len(card) > 80:
+        raise ValueError("format_header_card: value of %s does not fit in a card" % key)
+    return card.ljust(80).encode("utf-8")
+
+
+def format_header(header):
+    """ Format a header dict as the cards of a GUPPI header, ending with an END card
+
+    Args:
+        header (dict): keyword:value pairs of header metadata
+
+    Returns:
+        header (bytes): the formatted header
+    """
+    cards = [format_header_card(key, val) for key, val in header.items()]
+    cards.append(b'END'.ljust(80))
+    return b''.join(cards)
+
+
 class GuppiRaw(object):
     """ Python class for reading Guppi raw files
 
@@ -55,15 +326,27 @@ class GuppiRaw(object):
         n_blocks (int): if number of blocks to read is known, set it here.
                         This saves seeking through the file to check how many
                         integrations there are in the file.
+        cache_index (bool): load the block index from, and save it to, a
+                            sidecar file next to the .raw file. The sidecar
+                            is rebuilt whenever the file size or mtime change.
+        use_mmap (bool): memory-map the file and return 8-bit data as strided
+                         views into the file pages instead of copies. The
+                         views are read-only and only valid while the file
+                         is unchanged.
     """
 
-    def __init__(self, filename, n_blocks=None):
+    def __init__(self, filename, n_blocks=None, cache_index=True, use_mmap=False):
         self.filename = filename
         if PYTHON3:
             self.file_obj = open(filename, 'rb')
         else:
             self.file_obj = open(filename, 'r')
         self.filesize = os.path.getsize(filename)
+        self.cache_index = cache_index
+        self.index = None
+        self.headers = None
+        self.use_mmap = use_mmap
+        self._mmap = None
 
         if not n_blocks:
             self.n_blocks = self.find_n_data_blocks()
@@ -104,54 +387,46 @@ class GuppiRaw(object):
     def read_header(self):
         """ Read next header (multiple headers in file)
 
+        The whole header region is read in one call and split into 80-byte
+        cards with a NumPy view; values are typed with GUPPI_HEADER_TYPES.
+
         Returns:
             (header, data_idx) - a dictionary of keyword:value header data and
             also the byte index of where the corresponding data block resides.
         """
         start_idx = self.file_obj.tell()
-        key, val = '', ''
+        if start_idx + 80 > self.filesize:
+            raise EndOfFileError("End Of Data File")
+
+        read_size = HEADER_READ_SIZE
+        while True:
+            self.file_obj.seek(start_idx)
+            buf = self.file_obj.read(read_size)
+            n_cards = len(buf) // 80
+            # Keyword field of every card, as a strided view of the buffer
+            keys = np.frombuffer(buf, dtype='S8', count=n_cards * 10)[::10]
+            end_cards = np.flatnonzero(keys == END_CARD_KEY)
+            if len(end_cards):
+                n_cards = int(end_cards[0])
+                break
+            if start_idx + len(buf) >= self.filesize:
+                self.file_obj.seek(start_idx)
+                raise EndOfFileError("End Of Data File")
+            read_size *= 2
 
         header_dict = {}
-        keep_reading = True
-
-        first_line = self.file_obj
-
+        card = ''
         try:
-            while keep_reading:
-                if start_idx + 80 > self.filesize:
-                    keep_reading = False
-                    raise EndOfFileError("End Of Data File")
-                line = self.file_obj.read(80)
-                if PYTHON3:
-                    line = line.decode("utf-8")
-                # print line
-                if line.startswith('END'):
-                    keep_reading = False
-                    break
-                else:
-                    key, val = line.split('=')
-                    key, val = key.strip(), val.strip()
-
-                    if "'" in val:
-                        # Items in quotes are strings
-                        val = str(val.strip("'").strip())
-                    elif "." in val:
-                        # Items with periods are floats (if not a string)
-                        val = float(val)
-                    else:
-                        # Otherwise it's an integer
-                        val = int(val)
-
+            for card in np.frombuffer(buf, dtype='S80', count=n_cards).tolist():
+                key, val = parse_header_card(card)
                 header_dict[key] = val
         except ValueError:
-            print("CURRENT LINE: ", line)
+            print("CURRENT LINE: ", card)
             print("BLOCK START IDX: ", start_idx)
             print("FILE SIZE: ", self.filesize)
-            print("NEXT 512 BYTES: \n")
-            print(self.file_obj.read(512))
             raise
 
-        data_idx = self.file_obj.tell()
+        data_idx = start_idx + (n_cards + 1) * 80
 
         # Seek past padding if DIRECTIO is being used
         if "DIRECTIO" in header_dict.keys():
@@ -173,13 +448,12 @@ class GuppiRaw(object):
         self.file_obj.seek(0)
         return header_dict
 
-    def read_next_data_block_shape(self):
-        header, data_idx = self.read_header()
+    def _data_block_shape(self, header):
+        """ Shape of an unpacked data block: (n_samples, n_chan, n_pol) if CHANMAJ, else (n_chan, n_samples, n_pol) """
         n_chan = int(header['OBSNCHAN'])
         n_pol = int(header['NPOL'])
         n_bit = int(header['NBITS'])
-        n_samples = int(int(header['BLOCSIZE']) / (n_chan * n_pol * (n_bit / 8)))
-        print("NP",n_pol, n_bit)
+        n_samples = int(int(header['BLOCSIZE']) / (n_chan * n_pol * (n_bit / 8.)))
         is_chanmaj = False
         if 'CHANMAJ' in header.keys():
             if int(header['CHANMAJ']) == 1:
@@ -190,6 +464,11 @@ class GuppiRaw(object):
             dshape = (n_chan, int(n_samples), n_pol)
         return dshape
 
+    def read_next_data_block_shape(self):
+        header, data_idx = self.read_header()
+        print("NP", int(header['NPOL']), int(header['NBITS']))
+        return self._data_block_shape(header)
+
     def get_data(self, chan=-1, nchan=1):
         """
         returns a generator object that reads data a block at a time;
@@ -236,13 +515,15 @@ class GuppiRaw(object):
             n_pol = 4
         n_bit = int(header['NBITS'])
         blocsize= int(header['BLOCSIZE'])
-        if chan > 0:
-            data_idx = head_idx + chan * n_pol * int(n_bit / 8)
-            blocsize //= (n_chan//nchan)
-            n_chan = nchan
-        else:
-            data_idx = head_idx
-        self.file_obj.seek(data_idx,0)
+        if self.use_mmap or chan >= 0:
+            # Gather just the selected channels from the memory map
+            self.file_obj.seek(head_idx + blocsize)
+            data_x, data_y = self._read_channels(head_idx, header, chan_range(chan, nchan))
+            if self.use_mmap:
+                return header, data_x, data_y
+            self._d_x, self._d_y = np.ascontiguousarray(data_x), np.ascontiguousarray(data_y)
+            return header, self._d_x, self._d_y
+        self.file_obj.seek(head_idx,0)
 
 
         n_samples = int(blocsize / (n_chan * n_pol * (float(n_bit) / 8)))
@@ -261,11 +542,116 @@ class GuppiRaw(object):
         
         self._d_x[:] = d[..., 0:2]
         self._d_y[:] = d[..., 2:4]
-        if chan > 0:
-            data_idx = head_idx + header['BLOCSIZE']
-            self.file_obj.seek(data_idx,0)
         return header, self._d_x, self._d_y
 
+    def _get_mmap(self):
+        """ Memory map of the whole file, created on first use """
+        if self._mmap is None:
+            self._mmap = np.memmap(self.filename, dtype='int8', mode='r')
+        return self._mmap
+
+    def _raw_channels(self, data_idx, header, selection):
+        """ Bytes of the selected coarse channels of a data block, as views of the memory map
+
+        Returns:
+            data (np.memmap): int8 array of shape (n_selected, bytes_per_channel),
+            or (n_samples, n_selected, bytes_per_sample) if CHANMAJ
+        """
+        n_chan = int(header['OBSNCHAN'])
+        d = self._get_mmap()[data_idx:data_idx + int(header['BLOCSIZE'])]
+        if int(header.get('CHANMAJ', 0)) == 1:
+            return d.reshape((block_n_samples(header), n_chan, -1))[:, selection]
+        return d.reshape((n_chan, -1))[selection]
+
+    def _read_channels(self, data_idx, header, chans=None):
+        """ Gather the selected coarse channels of a data block from the memory map
+
+        Channels are contiguous byte ranges of the block, so only the pages of
+        the selected channels are read; CHANMAJ data interleaves channels sample
+        by sample and is gathered with a strided view instead. A contiguous
+        selection of 8-bit data is returned as views of the memory map without
+        any copy, anything else is gathered in a single fancy-indexing pass.
+
+        Returns: (data_x, data_y)
+            int8 arrays of shape (n_selected, n_samples, 2)
+        """
+        n_chan = int(header['OBSNCHAN'])
+        n_pol = int(header['NPOL'])
+        if n_pol == 2:
+            n_pol = 4
+        n_bit = int(header['NBITS'])
+        blocsize = int(header['BLOCSIZE'])
+        n_samples = blocsize * 8 // (n_chan * n_pol * n_bit)
+        selection = channel_selection(chans, n_chan)
+
+        d = self._raw_channels(data_idx, header, selection)
+        if int(header.get('CHANMAJ', 0)) == 1:
+            d = d.transpose(1, 0, 2)
+        if n_bit != 8:
+            d = unpack(np.ascontiguousarray(d).view('uint8'), n_bit)
+        d = d.reshape((d.shape[0], n_samples, n_pol))
+        return d[..., 0:2], d[..., 2:4]
+
+    def read_block_view(self, block_idx, chan=-1, nchan=1):
+        """ Zero-copy random access to an 8-bit data block
+
+        Returns: (header, data_x, data_y)
+            header (dict): dictionary of header metadata
+            data_x, data_y (np.memmap): read-only int8 views of shape (n_chan, n_samples, 2)
+        """
+        header = self.seek_block(block_idx)
+        if int(header['NBITS']) != 8:
+            raise ValueError("read_block_view: only 8-bit data can be viewed without a copy")
+        data_x, data_y = self._read_channels(int(self.index['data_idx'][block_idx]), header,
+                                             chan_range(chan, nchan))
+        return header, data_x, data_y
+
+    def read_block_channels(self, block_idx, chans=None):
+        """ Read the selected coarse channels of data block number block_idx
+
+        Blocks are read through the memory map without moving file_obj, so
+        this is safe to call from several threads at once.
+
+        Args:
+            block_idx (int): number of the data block in the file
+            chans (int, slice or list): coarse channels to read, all if None
+
+        Returns: (header, data_x, data_y)
+            header (dict): dictionary of header metadata
+            data_x, data_y (np.array): int8 arrays of shape (n_selected, n_samples, 2).
+                For a contiguous selection of 8-bit data these are read-only
+                views into the memory map.
+        """
+        self.find_n_data_blocks()
+        header = self.headers[block_idx]
+        data_x, data_y = self._read_channels(int(self.index['data_idx'][block_idx]), header, chans)
+        return header, data_x, data_y
+
+    def read_block_int8(self, block_idx, chan=-1, nchan=1):
+        """ Read nchan channels from chan (all if chan < 0) of data block number block_idx
+
+        See read_block_channels.
+        """
+        return self.read_block_channels(block_idx, chan_range(chan, nchan))
+
+    def read_block_raw(self, block_idx, chans=None):
+        """ Read the selected coarse channels of data block number block_idx as stored in the file
+
+        Nothing is unpacked, so this is the way to copy channels of 2-bit
+        and 4-bit data too.
+
+        Returns: (header, data)
+            header (dict): dictionary of header metadata
+            data (np.array): int8 bytes of the selected channels, of shape
+                (n_selected, bytes_per_channel), or (n_samples, n_selected,
+                bytes_per_sample) if CHANMAJ. A consecutive selection is a
+                view into the memory map.
+        """
+        self.find_n_data_blocks()
+        header = self.headers[block_idx]
+        selection = channel_selection(chans, int(header['OBSNCHAN']))
+        data = self._raw_channels(int(self.index['data_idx'][block_idx]), header, selection)
+        return header, data
 
     def read_next_data_block(self):
         """ Read the next block of data and its header
@@ -277,57 +663,112 @@ class GuppiRaw(object):
         header, data_idx = self.read_header()
         self.file_obj.seek(data_idx,0)
 
-        # Read data and reshape
+        # Read data, unpack 2-bit and 4-bit data and convert to complex64
 
-        n_chan = int(header['OBSNCHAN'])
-        n_pol = int(header['NPOL'])
         n_bit = int(header['NBITS'])
-        n_samples = int(int(header['BLOCSIZE']) / (n_chan * n_pol * (n_bit / 8)))
-
-        d = np.ascontiguousarray(np.fromfile(self.file_obj, count=header['BLOCSIZE'], dtype='int8'))
+        d = np.fromfile(self.file_obj, count=header['BLOCSIZE'], dtype='int8')
 
-        # Handle 2-bit and 4-bit data
-        if n_bit != 8:
-            d = unpack(d, n_bit)
+        dshape = self._data_block_shape(header)
+        dshape = dshape[:-1] + (dshape[-1] // 2,)  # Real, imag
 
-        dshape = self.read_next_data_block_shape()
+        if self._d.shape != dshape:
+            self._d = np.zeros(dshape, dtype='complex64')
 
-        d = d.reshape(dshape)  # Real, imag
+        to_complex64(d, n_bit, out=self._d)
 
-        if self._d.shape != d.shape:
-            self._d = np.zeros(d.shape, dtype='float32')
+        return header, self._d
 
-        self._d[:] = d
+    def build_index(self):
+        """ Seek through the file header by header and index every data block
 
-        return header, self._d[:].view('complex64')
-
-    def find_n_data_blocks(self):
-        """ Seek through the file to find how many data blocks there are in the file
+        A truncated block at the end of the file is left out of the index.
 
         Returns:
-            n_blocks (int): number of data blocks in the file
+            (index, headers) - structured array of BLOCK_INDEX_DTYPE with one
+            entry per data block, and the list of corresponding header dicts.
         """
+        entries = []
+        headers = []
         self.file_obj.seek(0)
-        header0, data_idx0 = self.read_header()
-
-        self.file_obj.seek(data_idx0)
-        block_size = int(header0['BLOCSIZE'])
-        n_bits = int(header0['NBITS'])
-        self.file_obj.seek(int(header0['BLOCSIZE']), 1)
-        n_blocks = 1
-        end_found = False
-        while not end_found:
+        while True:
+            header_idx = self.file_obj.tell()
             try:
                 header, data_idx = self.read_header()
-                self.file_obj.seek(data_idx)
-                self.file_obj.seek(header['BLOCSIZE'], 1)
-                n_blocks += 1
             except EndOfFileError:
-                end_found = True
                 break
+            blocsize = int(header['BLOCSIZE'])
+            if data_idx + blocsize > self.filesize:
+                break
+            entries.append((header_idx, data_idx, blocsize, int(header.get('PKTIDX', -1))))
+            headers.append(header)
+            self.file_obj.seek(data_idx + blocsize)
 
         self.file_obj.seek(0)
-        return n_blocks
+        return np.array(entries, dtype=BLOCK_INDEX_DTYPE), headers
+
+    def load_index(self):
+        """ Load the block index from its sidecar file
+
+        The index is rebuilt with build_index() if the sidecar is missing or
+        was written for a different file size or mtime, and then saved again.
+        Failing to write the sidecar (e.g. read-only archive) is not an error.
+
+        Returns:
+            (index, headers) - see build_index()
+        """
+        index_path = self.filename + INDEX_SUFFIX
+        mtime = os.path.getmtime(self.filename)
+        if self.cache_index:
+            try:
+                with np.load(index_path) as f:
+                    if int(f['filesize']) == self.filesize and float(f['mtime']) == mtime:
+                        return f['index'], json.loads(str(f['headers']))
+            except (IOError, OSError, KeyError, ValueError):
+                pass
+
+        index, headers = self.build_index()
+
+        if self.cache_index:
+            tmp_path = index_path + '.tmp.npz'
+            try:
+                np.savez(tmp_path, index=index, headers=json.dumps(headers),
+                         filesize=self.filesize, mtime=mtime)
+                os.rename(tmp_path, index_path)
+            except (IOError, OSError):
+                pass
+        return index, headers
+
+    def find_n_data_blocks(self):
+        """ Find how many data blocks there are in the file
+
+        The file is only scanned the first time; afterwards the block index is reused.
+
+        Returns:
+            n_blocks (int): number of data blocks in the file
+        """
+        if self.index is None:
+            self.index, self.headers = self.load_index()
+        return len(self.index)
+
+    def seek_block(self, block_idx):
+        """ Seek file_obj to the header of data block number block_idx
+
+        Returns:
+            header (dict): header of the block
+        """
+        self.find_n_data_blocks()
+        self.file_obj.seek(int(self.index['header_idx'][block_idx]))
+        return self.headers[block_idx]
+
+    def block_sample_offsets(self):
+        """ Sample number of the first sample of every block, see block_sample_offsets() """
+        self.find_n_data_blocks()
+        return block_sample_offsets(self.index['pktidx'], self.headers)
+
+    def block_start_times(self):
+        """ Time of the first sample of every block, see block_start_times() """
+        self.find_n_data_blocks()
+        return block_start_times(self.index['pktidx'], self.headers)
 
     def reset_index(self):
         """ Return file_obj seek to start of file """
@@ -348,6 +789,264 @@ class GuppiRaw(object):
 
    
 
+def find_sequence_files(filename):
+    """ Find the files of the multi-file scan that filename is part of
+
+    Args:
+        filename (str): one file of the scan, e.g. blc3_guppi_57386_VOYAGER1_0004.0000.raw
+
+    Returns:
+        filenames (list): filename and the files following it in the scan, in order.
+                          Just [filename] if it is not named like part of a scan.
+    """
+    dirname, basename = os.path.split(filename)
+    match = RAW_SEQUENCE_RE.match(basename)
+    if not match:
+        return [filename]
+    prefix, number = match.group(1), int(match.group(2))
+
+    files = []
+    for name in os.listdir(dirname or '.'):
+        sibling = RAW_SEQUENCE_RE.match(name)
+        if sibling and sibling.group(1) == prefix and int(sibling.group(2)) >= number:
+            files.append((int(sibling.group(2)), os.path.join(dirname, name)))
+    return [f for n, f in sorted(files)]
+
+
+class GuppiRawSequence(object):
+    """ Python class for reading a scan split over sequential Guppi raw files
+
+    All files of the scan are opened and indexed up front, and their blocks
+    numbered globally, so reads cross file boundaries without reopening.
+
+    Args:
+        filename (str): first .raw file of the scan to read, e.g. <prefix>.0000.raw
+
+    Optional args:
+        cache_index (bool): use sidecar block index files, see GuppiRaw
+    """
+
+    def __init__(self, filename, cache_index=True):
+        self.filename = filename
+        self.filenames = find_sequence_files(filename)
+        self.readers = [GuppiRaw(f, cache_index=cache_index) for f in self.filenames]
+
+        index = []
+        self.headers = []
+        for file_idx, reader in enumerate(self.readers):
+            entries = np.zeros(reader.n_blocks, dtype=SEQUENCE_INDEX_DTYPE)
+            entries['file_idx'] = file_idx
+            entries['block_idx'] = np.arange(reader.n_blocks)
+            entries['pktidx'] = reader.index['pktidx']
+            index.append(entries)
+            self.headers.extend(reader.headers)
+        self.index = np.concatenate(index)
+        self.n_blocks = len(self.index)
+        self.block_idx = 0
+
+    def __repr__(self):
+        return "<GuppiRawSequence file handler for %d files from %s>" % (len(self.filenames), self.filename)
+
+    def read_first_header(self):
+        """ Read first header of the scan """
+        return self.readers[0].read_first_header()
+
+    def find_n_data_blocks(self):
+        """ Number of data blocks in all files of the scan """
+        return self.n_blocks
+
+    def reset_index(self):
+        """ Rewind read_next_data_block_int8 to the first block of the scan """
+        self.block_idx = 0
+
+    def read_block_channels(self, block_idx, chans=None):
+        """ Read the selected channels of data block number block_idx of the scan,
+        see GuppiRaw.read_block_channels """
+        entry = self.index[block_idx]
+        return self.readers[int(entry['file_idx'])].read_block_channels(int(entry['block_idx']), chans)
+
+    def read_block_int8(self, block_idx, chan=-1, nchan=1):
+        """ Read data block number block_idx of the scan, see GuppiRaw.read_block_int8 """
+        return self.read_block_channels(block_idx, chan_range(chan, nchan))
+
+    def read_block_raw(self, block_idx, chans=None):
+        """ Read the selected channels of data block number block_idx of the scan as stored,
+        see GuppiRaw.read_block_raw """
+        entry = self.index[block_idx]
+        return self.readers[int(entry['file_idx'])].read_block_raw(int(entry['block_idx']), chans)
+
+    def read_next_data_block_int8(self, chan=-1, nchan=1):
+        """ Read the next block of the scan, crossing into the next file as needed
+
+        Returns: (header, data_x, data_y), or (None, None, None) at the end of the scan
+        """
+        if self.block_idx >= self.n_blocks:
+            return None, None, None
+        header, data_x, data_y = self.read_block_int8(self.block_idx, chan, nchan)
+        self.block_idx += 1
+        return header, data_x, data_y
+
+    def block_sample_offsets(self):
+        """ Sample number of the first sample of every block, see block_sample_offsets() """
+        return block_sample_offsets(self.index['pktidx'], self.headers)
+
+    def block_start_times(self):
+        """ Time of the first sample of every block, see block_start_times() """
+        return block_start_times(self.index['pktidx'], self.headers)
+
+    def find_dropped_blocks(self):
+        """ Find blocks missing from the scan, from gaps in PKTIDX
+
+        The PKTIDX step between blocks is taken from PIPERBLK if present,
+        and otherwise from the median step of the scan.
+
+        Returns:
+            dropped (list): (block_idx, n_dropped) pairs, meaning n_dropped
+                            blocks are missing just before block block_idx
+        """
+        pktidx = self.index['pktidx']
+        step = pktidx_step(pktidx, self.headers)
+        if step <= 0 or (pktidx < 0).any():
+            return []
+        n_dropped = np.diff(pktidx) // step - 1
+        return [(int(i) + 1, int(n_dropped[i])) for i in np.flatnonzero(n_dropped > 0)]
+
+
+class GuppiRawWriter(object):
+    """ Python class for writing Guppi raw files
+
+    Every block is written as its header, padded with spaces so the data
+    starts at a multiple of DIRECTIO_ALIGN bytes if directio is set, followed
+    by the data in one large write.
+
+    Args:
+        filename (str): name of the .raw file to write
+
+    Optional args:
+        directio (bool): pad headers for DIRECTIO readers, and set DIRECTIO = 1
+    """
+
+    def __init__(self, filename, directio=True):
+        self.filename = filename
+        self.directio = directio
+        self.file_obj = open(filename, 'wb')
+        self.n_blocks = 0
+        self.pos = 0
+        # Preallocated buffers for data that has to be rearranged before writing
+        self._data = np.zeros(0, dtype='int8')
+        self._block = np.zeros((0, 0, 4), dtype='int8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return "<GuppiRawWriter file handler for %s>" % self.filename
+
+    def write_block(self, header, data):
+        """ Write a header and data block
+
+        Args:
+            header (dict): keyword:value pairs of header metadata; BLOCSIZE
+                           and DIRECTIO are set to match what is written
+            data (np.array): int8 or uint8 bytes of the block, in the layout
+                             the header describes
+        """
+        if not data.flags.c_contiguous:
+            if self._data.size < data.size:
+                self._data = np.zeros(data.size, dtype='int8')
+            buf = self._data[:data.size].reshape(data.shape)
+            np.copyto(buf, data.view('int8'))
+            data = buf
+        header = dict(header)
+        header['BLOCSIZE'] = int(data.nbytes)
+        header['DIRECTIO'] = int(self.directio)
+        header = format_header(header)
+        if self.directio and (self.pos + len(header)) % DIRECTIO_ALIGN:
+            header += b' ' * (DIRECTIO_ALIGN - (self.pos + len(header)) % DIRECTIO_ALIGN)
+        self.file_obj.write(header)
+        data.tofile(self.file_obj)
+        self.pos += len(header) + data.nbytes
+        self.n_blocks += 1
+
+    def write_block_int8(self, header, data_x, data_y):
+        """ Write a block of 8-bit data, as returned by GuppiRaw.read_block_channels
+
+        Args:
+            header (dict): keyword:value pairs of header metadata
+            data_x, data_y (np.array): int8 (real, imag) pairs of shape (n_chan, n_samples, 2)
+        """
+        shape = data_x.shape[:2] + (4,)
+        if self._block.shape != shape:
+            self._block = np.zeros(shape, dtype='int8')
+        self._block[..., 0:2] = data_x
+        self._block[..., 2:4] = data_y
+        header = dict(header)
+        header['OBSNCHAN'] = shape[0]
+        header['NBITS'] = 8
+        header['NPOL'] = 4
+        header['CHANMAJ'] = 0
+        self.write_block(header, self._block)
+
+    def copy_blocks(self, reader, chans=None, start_block=0, stop_block=-1):
+        """ Copy data blocks of a GuppiRaw or GuppiRawSequence, keeping only the channels chans
+
+        The selected channels are copied as the raw bytes of the file,
+        whatever NBITS, so nothing is decoded or re-encoded.
+
+        Args:
+            reader (GuppiRaw or GuppiRawSequence): file to copy from
+            chans (None, int, slice or list): consecutive coarse channels to keep, all if None
+            start_block, stop_block (int): blocks to copy, stop_block exclusive and -1 for the end
+
+        Returns:
+            n_blocks (int): number of blocks copied
+        """
+        if stop_block < 0:
+            stop_block = reader.find_n_data_blocks()
+        for block_idx in range(start_block, stop_block):
+            header, data = reader.read_block_raw(block_idx, chans)
+            self.write_block(channel_subset_header(header, chans), data)
+        return max(stop_block - start_block, 0)
+
+    def close(self):
+        self.file_obj.close()
+
+
+def extract(filename, out_filename, chans=None, start_time=0.0, stop_time=-1.0, directio=True):
+    """ Cut coarse channels and a time window out of a GUPPI raw file or scan into a new file
+
+    Whole blocks are copied, from the one holding start_time to the one
+    holding stop_time, so that PKTIDX and the block timing stay valid.
+
+    Args:
+        filename (str): .raw file to read; every file of the scan if it is
+                        part of a multi-file scan
+        out_filename (str): .raw file to write
+        chans (None, int, slice or list): consecutive coarse channels to keep, all if None
+        start_time, stop_time (float): seconds from the first sample; stop_time < 0 for the end
+        directio (bool): write the new file with DIRECTIO padding
+
+    Returns:
+        n_blocks (int): number of blocks written
+    """
+    if RAW_SEQUENCE_RE.match(os.path.basename(filename)):
+        reader = GuppiRawSequence(filename)
+    else:
+        reader = GuppiRaw(filename)
+    n_blocks = reader.find_n_data_blocks()
+    channel_subset_header(reader.headers[0], chans)  # Check the selection before creating the file
+    times = reader.block_sample_offsets() * float(reader.headers[0]['TBIN'])
+    start_block = max(int(np.searchsorted(times, start_time, 'right')) - 1, 0)
+    stop_block = n_blocks
+    if stop_time >= 0:
+        stop_block = int(np.searchsorted(times, stop_time, 'left'))
+    with GuppiRawWriter(out_filename, directio) as writer:
+        return writer.copy_blocks(reader, chans, start_block, stop_block)
+
+
 def cmd_tool():
     path = "/home/yunfanz/Downloads/blc3_guppi_57386_VOYAGER1_0004.0000.raw"
     reader = GuppiRaw(path)
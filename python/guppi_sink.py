@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 
+# Copyright 2019 <+YOU OR YOUR COMPANY+>.
+# 
+# This is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+# 
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this software; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street,
+# Boston, MA 02110-1301, USA.
+# 
+
+
+import numpy as np
+from gnuradio import gr
+from guppi import GuppiRaw, GuppiRawWriter, MJD_UNIX_EPOCH
+from guppi_source import OUTPUT_TYPES, read_stream_tags
+from utils import complex64_pairs
+
+
+class guppi_sink(gr.sync_block):
+    """
+    Records streams like those of guppi_source to a GUPPI raw file.
+
+    Each channel has an X and a Y polarization input port (x0, y0, x1, y1, ...),
+    or with vector_input set, all of them come in on a single port as vectors
+    of nchan*2 samples in that order. in_type is one of guppi_source's
+    out_types: 'sc8' samples are written as they are, 'fc32' and 'sc16' ones
+    are multiplied by scale, rounded and clipped to 8 bits.
+
+    Every block_samples samples are written as an 8-bit data block, with
+    DIRECTIO alignment if directio is set; a partial last block is written
+    on stop(). Headers start from the first header of the template raw file,
+    if given. OBSFREQ, OBSBW and CHAN_BW are then taken from the rx_freq or
+    chan_freqs tags guppi_source emits, and STT_IMJD, STT_SMJD and STT_OFFS
+    from the first rx_time tag. PKTIDX counts samples, with PIPERBLK set to
+    block_samples. TBIN is tbin if given, else the template's, else
+    1 / CHAN_BW. The file is created when the flowgraph starts.
+    """
+    def __init__(self, filename, nchan=1, in_type='sc8', vector_input=0, block_samples=8192,
+                 scale=1.0, tbin=0.0, template='', directio=1):
+        self.dtype, n_values = OUTPUT_TYPES[in_type]
+        item = self.dtype if n_values == 1 else (self.dtype, n_values)
+        if vector_input:
+            in_sig = [(self.dtype, nchan * 2 * n_values)]
+        else:
+            in_sig = [item, item] * nchan
+        gr.sync_block.__init__(self,
+            name="guppi_sink",
+            in_sig=in_sig,
+            out_sig=None)
+        self.nchan = nchan
+        self.vector_input = bool(vector_input)
+        self.block_samples = int(block_samples)
+        self.scale = float(scale)
+        self.template = {}
+        if template:
+            self.template = GuppiRaw(template).read_first_header()
+        self.tbin = float(tbin) or float(self.template.get('TBIN', 0.0))
+        self.chan_freqs = np.full(nchan, np.nan)
+        self.rx_time = None
+        self.filename = filename
+        self.directio = bool(directio)
+        self.writer = None
+        # The block being filled, as (channel, sample, pol, real/imag), and
+        # float scratch space for converting samples to 8 bits
+        self.block = np.zeros((nchan, self.block_samples, 2, 2), dtype=np.int8)
+        self.scratch = np.zeros(0, dtype=np.float32)
+        self.n_filled = 0
+
+    def start(self):
+        self.writer = GuppiRawWriter(self.filename, directio=self.directio)
+        self.n_filled = 0
+        self.rx_time = None
+        return True
+
+    def stop(self):
+        if self.writer is not None:
+            if self.n_filled:
+                self.write_block()
+            self.writer.close()
+            self.writer = None
+        return True
+
+    def read_tags(self, n):
+        """ Pick up channel frequencies and the start time from the tags of the next n samples """
+        rx_time = read_stream_tags(self, n, self.nchan, self.vector_input, self.chan_freqs)
+        if self.rx_time is None:
+            self.rx_time = rx_time
+
+    def to_int8(self, samples, out):
+        """ Write (real, imag) pairs into the int8 array out, scaled and clipped unless they are int8 already """
+        if self.dtype == np.int8 and self.scale == 1:
+            out[...] = samples
+            return
+        if self.scratch.size < samples.size:
+            self.scratch = np.zeros(samples.size, dtype=np.float32)
+        buf = self.scratch[:samples.size].reshape(samples.shape)
+        np.multiply(samples, np.float32(self.scale), out=buf, casting='unsafe')
+        np.rint(buf, out=buf)
+        np.clip(buf, -128, 127, out=buf)
+        out[...] = buf
+
+    def pairs(self, samples):
+        """ View samples as (real, imag) pairs along a new last axis """
+        if self.dtype == np.complex64:
+            return complex64_pairs(samples)
+        return samples.reshape(samples.shape[:-1] + (-1, 2)) if self.vector_input else samples
+
+    def work(self, input_items, output_items):
+        n = len(input_items[0])
+        self.read_tags(n)
+        i = 0
+        while i < n:
+            k = min(n - i, self.block_samples - self.n_filled)
+            out = self.block[:, self.n_filled:self.n_filled + k]
+            if self.vector_input:
+                # (sample, channel, pol, real/imag) to (channel, sample, pol, real/imag)
+                samples = self.pairs(input_items[0][i:i + k]).reshape(k, self.nchan, 2, 2)
+                self.to_int8(samples.transpose(1, 0, 2, 3), out)
+            else:
+                for port, samples in enumerate(input_items):
+                    self.to_int8(self.pairs(samples[i:i + k]), out[port // 2, :, port % 2])
+            self.n_filled += k
+            i += k
+            if self.n_filled == self.block_samples:
+                self.write_block()
+        return n
+
+    def block_header(self):
+        """ Header of the block being written """
+        header = dict(self.template)
+        header.update({'OBSNCHAN': self.nchan, 'NPOL': 4, 'NBITS': 8, 'CHANMAJ': 0,
+                       'PKTIDX': self.writer.n_blocks * self.block_samples,
+                       'PIPERBLK': self.block_samples, 'PKTSTART': 0})
+        if not np.isnan(self.chan_freqs).any():
+            if self.nchan > 1:
+                header['CHAN_BW'] = (self.chan_freqs[1] - self.chan_freqs[0]) / 1e6
+            header['OBSFREQ'] = self.chan_freqs.mean() / 1e6
+            if 'CHAN_BW' in header:
+                header['OBSBW'] = float(header['CHAN_BW']) * self.nchan
+        tbin = self.tbin
+        if not tbin and header.get('CHAN_BW'):
+            tbin = 1.0 / abs(float(header['CHAN_BW']) * 1e6)
+        if not tbin:
+            raise ValueError("guppi_sink: TBIN is unknown, set tbin or a template file")
+        header['TBIN'] = tbin
+        if self.rx_time is not None:
+            # rx_time is the time of sample offset: step back to the first sample
+            secs, frac, offset = self.rx_time
+            frac -= offset * tbin
+            secs, frac = secs + int(np.floor(frac)), frac - np.floor(frac)
+            header['STT_IMJD'] = int(secs // 86400 + MJD_UNIX_EPOCH)
+            header['STT_SMJD'] = int(secs % 86400)
+            header['STT_OFFS'] = float(frac)
+        return header
+
+    def write_block(self):
+        self.writer.write_block(self.block_header(), self.block[:, :self.n_filled])
+        self.n_filled = 0
@@ -20,87 +20,438 @@
 # 
 
 import numpy as np
+import pmt
 from gnuradio import gr
-from guppi import GuppiRaw
+from guppi import GuppiRaw, GuppiRawSequence, block_n_samples, channel_frequencies, channel_selection
+from prefetcher import slot_prefetcher
+from utils import to_complex64
+
+# Output sample types: item dtype and number of values per complex sample
+OUTPUT_TYPES = {'fc32': (np.complex64, 1),  # complex float32
+                'sc16': (np.int16, 2),  # interleaved real, imag int16
+                'sc8': (np.int8, 2)}  # interleaved real, imag int8, as in the file
+
+
+class block_prefetcher(object):
+    """
+    Reads and decodes GUPPI blocks ahead of the consumer on a pool of worker threads.
+    Block number k of the stream is decoded into slot k % n_slots of a ring of
+    preallocated buffers, so blocks come out in order without copies. Slots
+    hold complex64 samples, or the raw int8 (real, imag) pairs if dtype is int8.
+    The stream runs over file blocks start_block to stop_block (exclusive, -1 for
+    the end of the file), wrapping around if repeat is set.
+    """
+    def __init__(self, reader, chans=None, n_ahead=2, repeat=False, n_threads=2,
+                 start_block=0, stop_block=-1, dtype=np.complex64):
+        self.reader = reader
+        self.chans = chans
+        self.dtype = dtype
+        self.repeat = repeat
+        if stop_block < 0:
+            stop_block = reader.find_n_data_blocks()
+        self.start_block = start_block
+        self.nblocks = stop_block - start_block
+        self.block_idx = -1
+        # One slot more than n_ahead for the block the consumer is working on
+        n_slots = n_ahead + 1
+        header, data_x, data_y = reader.read_block_channels(start_block, chans)
+        self.slots_x = [self._empty_slot(data_x) for i in range(n_slots)]
+        self.slots_y = [self._empty_slot(data_y) for i in range(n_slots)]
+        self.prefetcher = slot_prefetcher(self._load, n_slots, n_threads, "guppi_prefetch")
+
+    def _empty_slot(self, data):
+        if self.dtype == np.complex64:
+            return np.empty(data.shape[:-1], dtype=np.complex64)
+        return np.empty(data.shape, dtype=np.int8)
+
+    def _load(self, seq, slot):
+        if self.nblocks <= 0 or (seq >= self.nblocks and not self.repeat):
+            return None
+        block_idx = self.start_block + seq % self.nblocks
+        header, data_x, data_y = self.reader.read_block_channels(block_idx, self.chans)
+        if self.slots_x[slot].shape[:2] != data_x.shape[:2]:
+            self.slots_x[slot] = self._empty_slot(data_x)
+            self.slots_y[slot] = self._empty_slot(data_y)
+        for data, out in ((data_x, self.slots_x[slot]), (data_y, self.slots_y[slot])):
+            if self.dtype == np.complex64:
+                to_complex64(data, out=out)
+            else:
+                out[:] = data
+        return block_idx, header, self.slots_x[slot], self.slots_y[slot]
+
+    def next_block(self):
+        """
+        Wait for the next block of the stream.
+        Returns (header, dx, dy), or (None, None, None) once the file is exhausted.
+        dx and dy are only valid until the following call; the file block
+        they came from is left in block_idx.
+        """
+        block = self.prefetcher.next()
+        if block is None:
+            return None, None, None
+        self.block_idx, header, dx, dy = block
+        return header, dx, dy
+
+    def stop(self):
+        self.prefetcher.stop()
+
+
+class sample_ring(object):
+    """
+    Circular buffer of samples for n_chan channels.
+    Samples are pushed at the tail and popped from the head, both wrapping
+    around the end of the buffer, so streaming through it never reallocates.
+    A complex64 ring holds (n_chan, capacity) samples; an integer ring holds
+    (n_chan, capacity, 2) real, imag pairs.
+    """
+    def __init__(self, n_chan, capacity, dtype=np.complex64):
+        shape = (n_chan, capacity)
+        if dtype != np.complex64:
+            shape += (2,)
+        self.buf = np.zeros(shape, dtype=dtype)
+        self.capacity = capacity
+        self.head = 0
+        self.count = 0
+
+    def space(self):
+        return self.capacity - self.count
+
+    def _segments(self, start, n):
+        """ (ring slice, data slice) pairs covering n samples from ring position start """
+        start %= self.capacity
+        first = min(n, self.capacity - start)
+        segments = [(slice(start, start + first), slice(0, first))]
+        if first < n:
+            segments.append((slice(0, n - first), slice(first, n)))
+        return segments
+
+    def push(self, data):
+        """
+        Append data of shape (n_chan, n), either complex64 or int8 of shape
+        (n_chan, n, 2) holding real, imag pairs.
+        """
+        n = data.shape[1]
+        if n > self.space():
+            raise ValueError("sample_ring: %d samples do not fit in %d free" % (n, self.space()))
+        to_complex = self.buf.dtype == np.complex64 and data.dtype != np.complex64
+        for ring_slice, data_slice in self._segments(self.head + self.count, n):
+            if to_complex:
+                to_complex64(data[:, data_slice], out=self.buf[:, ring_slice])
+            else:
+                self.buf[:, ring_slice] = data[:, data_slice]
+        self.count += n
+
+    def pop(self, outs, n):
+        """ Move the oldest n samples of channel i into outs[i][:n] """
+        for ring_slice, data_slice in self._segments(self.head, n):
+            for i, out in enumerate(outs):
+                out[data_slice] = self.buf[i, ring_slice]
+        self._drop(n)
+
+    def pop_transposed(self, out, n):
+        """ Move the oldest n samples of all channels into out[:n], of shape (n, n_chan, ...) """
+        for ring_slice, data_slice in self._segments(self.head, n):
+            out[data_slice] = self.buf[:, ring_slice].swapaxes(0, 1)
+        self._drop(n)
+
+    def _drop(self, n):
+        self.head = (self.head + n) % self.capacity
+        self.count -= n
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+
+    def grow(self, capacity):
+        """ Reallocate to a larger capacity, keeping the buffered samples """
+        buf = np.zeros((self.buf.shape[0], capacity) + self.buf.shape[2:], dtype=self.buf.dtype)
+        count = self.count
+        self.pop(list(buf), count)
+        self.buf, self.capacity, self.head, self.count = buf, capacity, 0, count
+
+
+def read_stream_tags(block, n, nchan, vector_input, chan_freqs):
+    """ Read the tags guppi_source puts on the next n input items of a downstream block
+
+    Args:
+        block (gr.basic_block): block whose inputs are guppi_source outputs, with an
+                                X and a Y port per channel, or a single vector port
+        n (int): number of input items to look at
+        nchan (int): number of channels
+        vector_input (bool): whether the input is a single vector port
+        chan_freqs (np.array): channel frequencies in Hz, updated in place from
+                               chan_freqs and rx_freq tags
+
+    Returns:
+        rx_time (tuple): (secs, frac_secs, offset) of the first rx_time tag, or None
+    """
+    rx_time = None
+    ports = [0] if vector_input else range(0, 2 * nchan, 2)
+    for port in ports:
+        for tag in block.get_tags_in_window(port, 0, n):
+            key = pmt.symbol_to_string(tag.key)
+            if key == 'chan_freqs':
+                chan_freqs[:] = pmt.f64vector_elements(tag.value)
+            elif key == 'rx_freq' and not vector_input:
+                chan_freqs[port // 2] = pmt.to_double(tag.value)
+            elif key == 'rx_time' and rx_time is None:
+                rx_time = (pmt.to_uint64(pmt.tuple_ref(tag.value, 0)),
+                           pmt.to_double(pmt.tuple_ref(tag.value, 1)), tag.offset)
+    return rx_time
+
+
 class guppi_source(gr.sync_block):
     """
     docstring for block guppi_source
+
+    chan may also be a list of coarse channels, in which case nchan is ignored.
+
+    Each channel has an X and a Y polarization output port (x0, y0, x1, y1, ...),
+    or with vector_output set, all of them go to a single port as vectors of
+    nchan*2 samples in that order. out_type 'fc32' outputs complex64 samples;
+    'sc16' and 'sc8' pass the integer samples through as (real, imag) pairs
+    of int16 or int8 without converting them to float.
+
+    The first sample of every block is tagged with rx_time (tuple of whole and
+    fractional unix seconds), rx_freq (channel center frequency in Hz; in
+    vector mode the center of the selected channels, with every channel's
+    frequency in chan_freqs), block_start (block number) and pktidx (PKTIDX).
+    With prefetch > 0, that many blocks are read and decoded ahead of work()
+    by a pool of n_threads worker threads.
+    With multifile set, filename is the first file of a scan recorded as
+    <prefix>.0000.raw, <prefix>.0001.raw, ... and the whole scan is streamed.
+
+    Streaming starts start_time seconds plus sample_offset samples into block
+    start_block, and stops at whichever of stop_block (exclusive) and
+    stop_time comes first; -1 means the end of the file. Both times are
+    counted from the start of block start_block, using TBIN and PKTIDX.
+    Seeks go straight to the block through the block index, and each setting
+    can be changed while running without affecting the others; a stop at or
+    before the start streams nothing.
     """
-    def __init__(self, filename, chan=-1, nchan=1, repeat=0):
+    def __init__(self, filename, chan=-1, nchan=1, repeat=0, prefetch=0, n_threads=2, multifile=0,
+                 start_block=0, stop_block=-1, start_time=0.0, stop_time=-1.0, sample_offset=0,
+                 out_type='fc32', vector_output=0):
+        if isinstance(chan, (list, tuple)):
+            # An arbitrary list of coarse channels, read with one gather per block
+            chans = list(chan)
+            nchan = len(chans)
+        else:
+            # Only the first nchan channels are output, so only those are read
+            chans = slice(max(chan, 0), max(chan, 0) + nchan)
+        self.dtype, n_values = OUTPUT_TYPES[out_type]
+        item = self.dtype if n_values == 1 else (self.dtype, n_values)
+        if vector_output:
+            out_sig = [(self.dtype, nchan * 2 * n_values)]
+        else:
+            out_sig = [item, item] * nchan
         gr.sync_block.__init__(self,
             name="guppi_source",
             in_sig=None,
-            out_sig=[np.complex64,np.complex64]*nchan)
-        self.reader = GuppiRaw(filename) 
+            out_sig=out_sig)
+        if multifile:
+            self.reader = GuppiRawSequence(filename)
+            for block_idx, n_dropped in self.reader.find_dropped_blocks():
+                print("Warning: %d blocks dropped before block %d" % (n_dropped, block_idx))
+        else:
+            self.reader = GuppiRaw(filename)
+        if self.reader.find_n_data_blocks() == 0:
+            raise ValueError("guppi_source: %s has no complete data blocks" % filename)
         self.header = self.reader.read_first_header()
-        self.nblocks = self.reader.find_n_data_blocks()
+        # Catch channels outside the file here, not as a shape mismatch in work()
+        if nchan < 1:
+            raise ValueError("guppi_source: nchan must be at least 1, not %d" % nchan)
+        channel_selection(chans, int(self.header['OBSNCHAN']))
+        self.nblocks = self.reader.n_blocks
         self.chan = chan
         self.nchan = nchan
+        self.chans = chans
+        self.vector_output = bool(vector_output)
         self.block_idx = 0
         self.block_size = -1
-        self.idx = -1
+        self.ring_x = None
+        self.ring_y = None
         self.repeat = bool(repeat)
+        self.prefetch = int(prefetch)
+        self.n_threads = int(n_threads)
+        self.prefetcher = None
+        self.tbin = float(self.header['TBIN'])
+        self.offsets = self.reader.block_sample_offsets()
+        self.time_secs, self.time_frac = self.reader.block_start_times()
+        self.pending_tags = []
+        self.start_block = int(start_block)
+        self.stop_block = int(stop_block)
+        self.start_time = float(start_time)
+        self.stop_time = float(stop_time)
+        self.sample_offset = int(sample_offset)
+        self.seek()
+        if self.empty:
+            raise ValueError("guppi_source: the stop is not after the start")
+
+    def set_block_range(self, start_block, stop_block=-1):
+        """ Stream file blocks start_block to stop_block (exclusive) """
+        self.start_block, self.stop_block = int(start_block), int(stop_block)
+        self.seek_pending = True
+
+    def set_time_range(self, start_time, stop_time=-1.0):
+        """ Stream from start_time to stop_time seconds after the start of block start_block """
+        self.start_time, self.stop_time = float(start_time), float(stop_time)
+        self.seek_pending = True
+
+    def set_sample_offset(self, sample_offset):
+        """ Skip sample_offset samples past the start block or time """
+        self.sample_offset = int(sample_offset)
+        self.seek_pending = True
+
+    def seek(self):
+        """
+        Turn the start and stop settings into the first and last block to read
+        and the samples to trim off them, and restart streaming from there.
+        """
+        self.seek_pending = False
+        offsets = self.offsets
+        base = offsets[min(max(self.start_block, 0), self.nblocks - 1)]
+        start_sample = base + int(round(self.start_time / self.tbin)) + self.sample_offset
+        stop_sample = -1
+        if 0 <= self.stop_block < self.nblocks:
+            stop_sample = offsets[self.stop_block]
+        if self.stop_time >= 0:
+            stop_time_sample = base + int(round(self.stop_time / self.tbin))
+            if stop_sample < 0 or stop_time_sample < stop_sample:
+                stop_sample = stop_time_sample
+        end_sample = offsets[-1] + block_n_samples(self.reader.headers[-1])
+        if stop_sample < 0 or stop_sample > end_sample:
+            stop_sample = end_sample
+        self.stop_sample = stop_sample
+        self.empty = stop_sample <= start_sample
+
+        self.first_block = max(int(np.searchsorted(offsets, start_sample, 'right')) - 1, 0)
+        self.skip = start_sample - offsets[self.first_block]
+        self.last_block = self.nblocks
+        if stop_sample >= 0:
+            self.last_block = int(np.searchsorted(offsets, stop_sample, 'left'))
+        self.block_idx = self.first_block
+        self.pending_tags = []
+        if self.ring_x is not None:
+            self.ring_x.clear()
+            self.ring_y.clear()
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.start()
+
+    def start(self):
+        if self.prefetch > 0:
+            self.prefetcher = block_prefetcher(self.reader, self.chans,
+                                               self.prefetch, self.repeat, self.n_threads,
+                                               self.first_block, self.last_block,
+                                               np.complex64 if self.dtype == np.complex64 else np.int8)
+        return True
+
+    def stop(self):
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+        return True
 
     def work(self, input_items, output_items):
-        #outx, outy = output_items[0], output_items[1]
-        self.buffer_size = len(output_items[0])
-        work_done = 0
-        if self.idx < 0:
-            work_done = self.set_data()
-            self.data_iterator = self.output_generator()
-        try:
-            next_outs = next(self.data_iterator)
-        except(StopIteration):
-            work_done = self.set_data()
-            self.data_iterator = self.output_generator()
-            
-            next_outs = next(self.data_iterator)
-        self.idx += self.buffer_size
-        #print("buffer sizes", self.buffer_size, next_outs[0].shape)
-        for i in range(self.nchan):
-            output_items[2*i][:] = next_outs[0][i]
-            output_items[2*i+1][:] = next_outs[1][i]
-        if work_done < 0:
+        if self.seek_pending:
+            self.seek()
+        n = len(output_items[0])
+        # Top up the ring buffers with whole blocks, then drain what was asked for
+        while self.ring_x is None or (self.ring_x.count < n and self.ring_x.space() >= self.block_size):
+            if self.set_data() < 0:
+                break
+        if self.ring_x is None or self.ring_x.count == 0:
             return -1
+        n = min(n, self.ring_x.count)
+        if self.vector_output:
+            out = output_items[0][:n].reshape((n, self.nchan, 2) + self.ring_x.buf.shape[2:])
+            self.ring_x.pop_transposed(out[:, :, 0], n)
+            self.ring_y.pop_transposed(out[:, :, 1], n)
         else:
-            return len(output_items[0])
+            self.ring_x.pop(output_items[0::2], n)
+            self.ring_y.pop(output_items[1::2], n)
+        self.add_block_tags(self.nitems_written(0) + n)
+        return n
 
-    def output_generator(self):
-        while self.idx + self.buffer_size < self.block_size:
-            yield self.dx[:,self.idx:self.idx + self.buffer_size], self.dy[:,self.idx:self.idx + self.buffer_size]
+    def add_block_tags(self, end):
+        """ Emit the pending block tags for items before end """
+        while self.pending_tags and self.pending_tags[0][0] < end:
+            offset, tags = self.pending_tags.pop(0)
+            for port, key, value in tags:
+                self.add_item_tag(port, offset, pmt.intern(key), value)
+
+    def queue_block_tags(self, block_idx, header, begin):
+        """
+        Queue the tags of a block whose sample begin is the next one pushed
+        to the ring buffers. They are emitted once work() outputs that sample.
+        """
+        offset = self.nitems_written(0) + self.ring_x.count
+        common = [('block_start', pmt.from_long(block_idx)),
+                  ('pktidx', pmt.from_long(int(header.get('PKTIDX', -1))))]
+        if self.time_secs is not None:
+            frac = self.time_frac[block_idx] + begin * self.tbin
+            common.append(('rx_time', pmt.make_tuple(pmt.from_uint64(int(self.time_secs[block_idx] + frac // 1)),
+                                                     pmt.from_double(frac % 1))))
+        freqs = channel_frequencies(header)
+        freqs = np.atleast_1d(freqs[channel_selection(self.chans, len(freqs))])
+        tags = []
+        if self.vector_output:
+            tags.append((0, 'rx_freq', pmt.from_double(float(freqs.mean()))))
+            tags.append((0, 'chan_freqs', pmt.init_f64vector(len(freqs), [float(f) for f in freqs])))
+            tags += [(0, key, value) for key, value in common]
+        else:
+            for i, freq in enumerate(freqs):
+                for port in (2 * i, 2 * i + 1):
+                    tags.append((port, 'rx_freq', pmt.from_double(float(freq))))
+                    tags += [(port, key, value) for key, value in common]
+        self.pending_tags.append((offset, tags))
 
     def set_data(self):
-        if self.block_idx >= self.nblocks:
-            if self.repeat:
-                self.block_idx = 0
-                self.reader.reset_index()
-            else:
+        """
+        Read the selected channels of the next block into the ring buffers.
+        Returns -1 at the end of the file, 0 otherwise.
+        """
+        if self.empty:
+            print("Nothing to stream between the start and stop, exiting")
+            return -1
+        if self.prefetcher is not None:
+            header, dx, dy = self.prefetcher.next_block()
+            if header is None:
                 print("End of file, exiting")
                 return -1
-        print("block progression", self.block_idx, self.nblocks)
-        oldx = None
-        if self.idx < self.block_size:
-            oldx = self.dx[:,self.idx:]
-            oldy = self.dy[:,self.idx:]
-        self.header, self.dx, self.dy = self.reader.read_next_data_block_int8(self.chan, self.nchan)
-        #print("dx shape", self.dx.shape)
-        self.dx = (self.dx[...,0].astype(np.float32) + 1.j*self.dx[...,1].astype(np.float32)).astype(np.complex64)
-        self.dy = (self.dy[...,0].astype(np.float32) + 1.j*self.dy[...,1].astype(np.float32)).astype(np.complex64)
-
-        if oldx is not None:
-            print(oldx.shape, self.dx.shape)
-            self.dx = np.concatenate([oldx, self.dx], axis=-1)
-            self.dy = np.concatenate([oldy, self.dy], axis=-1)
-            print(oldx.shape, self.dx.shape)
-            oldx = None
-            oldy = None
-        self.block_size = self.dx.shape[-1]
-        self.n_steps = int(self.block_size//self.buffer_size)
-        self.block_idx += 1
-        self.idx = 0
-
-        return 0
-        
-
+            block_idx = self.prefetcher.block_idx
+        else:
+            if self.block_idx >= self.last_block:
+                if self.repeat:
+                    self.block_idx = self.first_block
+                else:
+                    print("End of file, exiting")
+                    return -1
+            block_idx = self.block_idx
+            header, dx, dy = self.reader.read_block_channels(block_idx, self.chans)
+            self.block_idx += 1
+        print("block progression", block_idx, self.nblocks)
+        self.header = header
+        self.block_size = dx.shape[1]
 
+        # Trim the samples outside the start and stop positions
+        begin, end = 0, self.block_size
+        if block_idx == self.first_block:
+            begin = self.skip
+        if self.stop_sample >= 0:
+            end = min(end, self.stop_sample - self.offsets[block_idx])
+        dx, dy = dx[:, begin:end], dy[:, begin:end]
 
+        if self.ring_x is None:
+            # Room for one full block on top of whatever is left of the previous one
+            self.ring_x = sample_ring(self.nchan, 2 * self.block_size, self.dtype)
+            self.ring_y = sample_ring(self.nchan, 2 * self.block_size, self.dtype)
+        elif self.ring_x.space() < self.block_size:
+            self.ring_x.grow(self.ring_x.count + self.block_size)
+            self.ring_y.grow(self.ring_y.count + self.block_size)
+        if dx.shape[1] > 0:
+            self.queue_block_tags(block_idx, header, begin)
+        self.ring_x.push(dx)
+        self.ring_y.push(dy)
+        return 0
@@ -19,38 +19,236 @@
 # Boston, MA 02110-1301, USA.
 # 
 
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 import numpy
 from gnuradio import gr
-import tensorflow as tf
-from keras.layers import Dense, Dropout, Input, Flatten
-from keras.models import Model, Sequential, load_model
-import keras.models
 import numpy as np
 
+POLL_INTERVAL = 0.1  # Seconds between checks that the trainer is still alive while waiting for it
+
 
 class keras_train(gr.sync_block):
     """
-    Block that outputs the result of running a single-layer
-    Keras model on input vectors from a signal source.
+    Block that trains a single-layer Keras autoencoder on input
+    vectors from a signal source, or continues training the model
+    saved at path.
     Requires an input_size for the vector length.
+    Vectors are collected into batches of batch_size and trained on by a
+    background thread, with up to queue_size batches waiting. If the trainer
+    falls behind, policy 'drop' discards new batches so the flowgraph keeps
+    its pace, and 'block' waits for the trainer instead.
+    With mode 'infer', the model saved at path is run on the input vectors
+    instead, and the mean squared reconstruction error of each vector is
+    output. Vectors are batched up to batch_size, or for at most max_latency
+    seconds, on a background thread.
     """
-    def __init__(self, input_size, path=None):
+    def __init__(self, input_size, path=None, batch_size=32, queue_size=8, policy='drop',
+                 mode='train', max_latency=0.1):
         gr.sync_block.__init__(self,
             name="keras_train",
             in_sig=[(numpy.float32, input_size)],
-            out_sig=None)
-       	self.input = Input(shape=(input_size,))
-       	self.z = Dense(32, activation='relu')(self.input)
-       	self.x = Dense(input_size, activation='tanh')(self.z)
+            out_sig=[numpy.float32] if mode == 'infer' else None)
+        if policy not in ('drop', 'block'):
+            raise ValueError("keras_train: unknown policy %s" % policy)
+        if mode not in ('train', 'infer'):
+            raise ValueError("keras_train: unknown mode %s" % mode)
+        if mode == 'infer' and not path:
+            raise ValueError("keras_train: inference needs the path of a saved model")
+        # Keras (and TensorFlow behind it) is only imported once the block is used
+        import keras
         self.input_size = input_size
-       	self.model = Model(self.input, self.x)
-       	self.model.compile(loss='mean_squared_error', optimizer='sgd')
-        self.model.summary()
-    
+        self.path = path
+        self.batch_size = batch_size
+        self.policy = policy
+        self.mode = mode
+        self.max_latency = max_latency
+        self.model = None
+        self.loss = None
+        self.n_trained = 0
+        self.n_dropped = 0
+        self.error = None
+        self.trainer = None
+        if mode == 'train':
+            # Batch buffers cycle from free, to being filled by work(), to the
+            # batches queue, to the trainer and back to free
+            self.free = queue.Queue()
+            for i in range(queue_size):
+                self.free.put(np.empty((batch_size, input_size), dtype=np.float32))
+            self.batches = queue.Queue()
+            self.batch = np.empty((batch_size, input_size), dtype=np.float32)
+            self.n_filled = 0
+        else:
+            # Input chunks waiting for the model, arrays of errors computed
+            # from them, and how many inputs have been queued but not output
+            self.chunks = queue.Queue()
+            self.results = queue.Queue()
+            self.scores = np.zeros(0, dtype=np.float32)
+            self.n_scored = 0
+            self.n_pending = 0
+
+    def build_model(self):
+        from keras.layers import Dense, Input
+        from keras.models import Model, load_model
+        if self.path:
+            return load_model(self.path)
+        input = Input(shape=(self.input_size,))
+        z = Dense(32, activation='relu')(input)
+        x = Dense(self.input_size, activation='tanh')(z)
+        model = Model(input, x)
+        model.compile(loss='mean_squared_error', optimizer='sgd')
+        return model
+
+    def train(self):
+        try:
+            # Keras models are built on the thread that uses them
+            self.model = self.build_model()
+            self.model.summary()
+            while True:
+                batch = self.batches.get()
+                if batch is None:
+                    return
+                self.loss = self.model.train_on_batch(batch, batch)
+                self.n_trained += 1
+                self.free.put(batch)
+        except Exception as e:
+            self.error = e
+
+    def next_batch(self, batch, chunk, offset):
+        """
+        Fill batch from the queued chunks, starting at chunk[offset], until it is
+        full, max_latency has passed since its first vector, or an empty chunk
+        asks for it to be flushed.
+        Returns (n, chunk, offset): the vectors in batch, and where to carry on
+        from; n is None once the block is stopping.
+        """
+        n = 0
+        deadline = None
+        while n < len(batch):
+            if chunk is None:
+                timeout = None if deadline is None else max(deadline - time.time(), 0)
+                try:
+                    chunk = self.chunks.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if chunk is None:
+                    return None, None, 0
+                offset = 0
+                if not len(chunk):
+                    chunk = None
+                    if n:
+                        break
+                    continue
+            if deadline is None:
+                deadline = time.time() + self.max_latency
+            k = min(len(chunk) - offset, len(batch) - n)
+            batch[n:n + k] = chunk[offset:offset + k]
+            n += k
+            offset += k
+            if offset == len(chunk):
+                chunk = None
+        return n, chunk, offset
+
+    def infer(self):
+        try:
+            self.model = self.build_model()
+            batch = np.empty((self.batch_size, self.input_size), dtype=np.float32)
+            chunk, offset = None, 0
+            while True:
+                n, chunk, offset = self.next_batch(batch, chunk, offset)
+                if n is None:
+                    return
+                reconstructed = np.asarray(self.model.predict_on_batch(batch[:n]))
+                errors = np.mean((reconstructed - batch[:n]) ** 2, axis=1).astype(np.float32)
+                self.results.put(errors)
+        except Exception as e:
+            self.error = e
+            self.results.put(None)
+
+    def start(self):
+        target = self.infer if self.mode == 'infer' else self.train
+        self.trainer = threading.Thread(target=target, name="keras_" + self.mode)
+        self.trainer.daemon = True
+        self.trainer.start()
+        return True
+
+    def stop(self):
+        if self.trainer is not None:
+            if self.mode == 'infer':
+                self.chunks.put(None)
+            else:
+                self.batches.put(None)
+            self.trainer.join()
+            self.trainer = None
+        return True
+
+    def submit_batch(self):
+        if self.policy == 'drop':
+            try:
+                next_batch = self.free.get(block=False)
+            except queue.Empty:
+                # Every buffer is waiting for the trainer: drop this batch and refill it
+                self.n_dropped += 1
+                self.n_filled = 0
+                return
+        else:
+            next_batch = None
+            while next_batch is None:
+                try:
+                    next_batch = self.free.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    # A trainer that died will never free a buffer
+                    if self.error is not None:
+                        raise self.error
+        self.batches.put(self.batch)
+        self.batch = next_batch
+        self.n_filled = 0
 
     def work(self, input_items, output_items):
-        in0 = input_items[0][:]
-        print(in0.shape,input_items[0].shape, "inshape")
-        loss = self.model.train_on_batch(in0, in0)
-        print(loss)
-        return input_items[0].size
+        if self.error is not None:
+            raise self.error
+        if self.mode == 'infer':
+            return self.work_infer(input_items, output_items)
+        in0 = input_items[0]
+        i = 0
+        while i < len(in0):
+            n = min(len(in0) - i, self.batch_size - self.n_filled)
+            self.batch[self.n_filled:self.n_filled + n] = in0[i:i + n]
+            self.n_filled += n
+            i += n
+            if self.n_filled == self.batch_size:
+                self.submit_batch()
+        return len(in0)
+
+    def work_infer(self, input_items, output_items):
+        in0 = input_items[0]
+        out = output_items[0]
+        # Inputs are only consumed once their errors are output, so the first
+        # n_pending of in0 are already queued: queue the rest.
+        if len(in0) > self.n_pending:
+            self.chunks.put(in0[self.n_pending:].copy())
+            self.n_pending = len(in0)
+        n_out = 0
+        while n_out < len(out):
+            if self.n_scored == len(self.scores):
+                if n_out == 0 and self.results.empty():
+                    # No more inputs can arrive while we wait, so don't hold the batch back for them
+                    self.chunks.put(in0[:0])
+                try:
+                    # Wait for the oldest batch only if there is nothing else to output
+                    scores = self.results.get(block=n_out == 0)
+                except queue.Empty:
+                    break
+                if scores is None:
+                    raise self.error
+                self.scores, self.n_scored = scores, 0
+            n = min(len(out) - n_out, len(self.scores) - self.n_scored)
+            out[n_out:n_out + n] = self.scores[self.n_scored:self.n_scored + n]
+            self.n_scored += n
+            n_out += n
+        self.n_pending -= n_out
+        return n_out
@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 
+# Copyright 2019 <+YOU OR YOUR COMPANY+>.
+# 
+# This is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+# 
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this software; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street,
+# Boston, MA 02110-1301, USA.
+# 
+"""
+# multistream_canvas.py
+
+vispy canvases for multistream_qt: line plots and waterfalls of many
+signals in a table of subplots, fed from another thread through frame_slot
+and row_ring. Kept apart from the block so vispy is only imported when a
+display is created.
+"""
+from vispy import gloo
+from vispy import app
+import numpy as np
+from utils import envelope
+import math
+
+VERT_SHADER = """
+#version 120
+
+// y coordinate of the position.
+attribute float a_position;
+
+// row, col, and time index.
+attribute vec3 a_index;
+varying vec3 v_index;
+
+// 2D scaling factor (zooming).
+uniform vec2 u_scale;
+
+// Size of the table.
+uniform vec2 u_size;
+
+// Number of samples per signal.
+uniform float u_n;
+
+// Color.
+attribute vec3 a_color;
+varying vec4 v_color;
+
+// Varying variables used for clipping in the fragment shader.
+varying vec2 v_position;
+varying vec4 v_ab;
+
+void main() {
+    float nrows = u_size.x;
+    float ncols = u_size.y;
+
+    // Compute the x coordinate from the time index.
+    float x = -1 + 2*a_index.z / (u_n-1);
+    vec2 position = vec2(x - (1 - 1 / u_scale.x), a_position);
+
+    // Find the affine transformation for the subplots.
+    vec2 a = vec2(1./ncols, 1./nrows)*.9;
+    vec2 b = vec2(-1 + 2*(a_index.x+.5) / ncols,
+                  -1 + 2*(a_index.y+.5) / nrows);
+    // Apply the static subplot transformation + scaling.
+    gl_Position = vec4(a*u_scale*position+b, 0.0, 1.0);
+
+    v_color = vec4(a_color, 1.);
+    v_index = a_index;
+
+    // For clipping test in the fragment shader.
+    v_position = gl_Position.xy;
+    v_ab = vec4(a, b);
+}
+"""
+
+FRAG_SHADER = """
+#version 120
+
+varying vec4 v_color;
+varying vec3 v_index;
+
+varying vec2 v_position;
+varying vec4 v_ab;
+
+void main() {
+    gl_FragColor = v_color;
+
+    // Discard the fragments between the signals (emulate glMultiDrawArrays).
+    if ((fract(v_index.x) > 0.) || (fract(v_index.y) > 0.))
+        discard;
+
+    // Clipping test.
+    vec2 test = abs((v_position.xy-v_ab.zw)/v_ab.xy);
+    if ((test.x > 1) || (test.y > 1))
+        discard;
+}
+"""
+
+WATERFALL_VERT_SHADER = """
+#version 120
+
+// Corners of the full window quad.
+attribute vec2 a_position;
+varying vec2 v_position;
+
+void main() {
+    gl_Position = vec4(a_position, 0.0, 1.0);
+    v_position = (a_position + 1.) / 2.;
+}
+"""
+
+WATERFALL_FRAG_SHADER = """
+#version 120
+
+// Power spectra in dB, one tile of u_n_history rows per signal, laid out
+// like the table of subplots.
+uniform sampler2D u_texture;
+
+// Size of the table.
+uniform vec2 u_size;
+
+// Number of rows in each tile, and the next row to be written.
+uniform float u_n_history;
+uniform float u_offset;
+
+// Levels mapped to the ends of the color map.
+uniform vec2 u_clim;
+
+varying vec2 v_position;
+
+vec3 colormap(float x) {
+    return clamp(vec3(3.*x, 3.*x - 1., 3.*x - 2.), 0., 1.);
+}
+
+void main() {
+    float nrows = u_size.x;
+    float ncols = u_size.y;
+    vec2 tile = floor(v_position * vec2(ncols, nrows));
+    vec2 local = fract(v_position * vec2(ncols, nrows));
+
+    // Each tile is a circular buffer: draw the newest row at the top and
+    // older ones below, so scrolling only needs u_offset to change.
+    float age = floor((1. - local.y) * u_n_history);
+    float row = mod(u_offset - 1. - age + u_n_history, u_n_history);
+    vec2 uv = vec2((tile.x + local.x) / ncols,
+                   (tile.y * u_n_history + row + .5) / (nrows * u_n_history));
+
+    float level = (texture2D(u_texture, uv).r - u_clim.x) / (u_clim.y - u_clim.x);
+    gl_FragColor = vec4(colormap(clamp(level, 0., 1.)), 1.);
+}
+"""
+
+
+class frame_slot(object):
+    """
+    Hands the latest frame from one writer thread to one reader thread without locks.
+    The writer fills n_frames preallocated frames in turn and publishes the
+    number of the newest one; the reader takes whichever frame is newest when
+    it gets round to it, so frames in between are dropped and the writer
+    never waits.
+    """
+    def __init__(self, shape, dtype=np.float32, n_frames=3):
+        self.frames = [np.zeros(shape, dtype=dtype) for i in range(n_frames)]
+        self.writing = 0
+        self.latest = 0
+
+    def begin_write(self):
+        """ Returns the array to write the next frame into """
+        self.writing += 1
+        return self.frames[self.writing % len(self.frames)]
+
+    def end_write(self):
+        """ Publish the frame written since begin_write """
+        self.latest = self.writing
+
+    def latest_frame(self):
+        """ Returns (seq, frame): the number and array of the newest complete frame """
+        seq = self.latest
+        return seq, self.frames[seq % len(self.frames)]
+
+    def overwritten(self, seq):
+        """ Whether the writer may have started on frame seq's array since it was read """
+        return self.writing - seq >= len(self.frames)
+
+
+class row_ring(object):
+    """
+    Hands rows from one writer thread to one reader thread without locks.
+    The writer appends rows to a circular buffer of n_rows; the reader picks
+    up the rows written since it last looked, so rows are only lost if it
+    falls a whole buffer behind. A row the writer may have started to
+    overwrite while it was being read is reported by overwritten().
+    """
+    def __init__(self, n_rows, shape, dtype=np.float32):
+        self.rows = np.zeros((n_rows,) + shape, dtype=dtype)
+        self.n_rows = n_rows
+        self.written = 0
+
+    def begin_write(self):
+        """ Returns the array to write the next row into """
+        return self.rows[self.written % self.n_rows]
+
+    def end_write(self):
+        """ Publish the row written since begin_write """
+        self.written += 1
+
+    def runs(self, start, stop):
+        """
+        Split rows start to stop into at most two runs that do not wrap around the buffer.
+        Returns (seq, r0, r1) triples: the number of the first row of the run
+        and its slots. The oldest rows are skipped if the writer has lapped
+        them, as is the slot it is filling, whose row is stop.
+        """
+        start = max(start, stop - self.n_rows + 1)
+        runs = []
+        while start < stop:
+            r0 = start % self.n_rows
+            n = min(stop - start, self.n_rows - r0)
+            runs.append((start, r0, r0 + n))
+            start += n
+        return runs
+
+    def overwritten(self, seq):
+        """ Whether the writer may have started on row seq's slot since it was published """
+        return self.written - seq >= self.n_rows
+
+
+class Canvas(app.Canvas):
+    def __init__(self,nrows=8,ncols=8, n=1000, streamer=None, n_pixels=512, max_fps=30, frames=None):
+        app.Canvas.__init__(self, title='Use your wheel to zoom!',
+                            keys='interactive')
+        self.streamer = streamer
+        # Number of cols and rows in the table.
+        self.nrows = nrows
+        self.ncols = ncols
+
+        # Number of signals.
+        self.m = nrows*ncols
+
+        # Number of samples per signal.
+        self.n = n
+
+        # Signals longer than n_pixels are decimated to a min/max envelope of
+        # n_pixels columns, drawn with two vertices per column.
+        self.decimate = n > n_pixels
+        self.n_x = n_pixels if self.decimate else n
+        self.n_vert = 2 * self.n_x if self.decimate else n
+
+        # Incoming (m, n) frames, the number of the last one uploaded, and a
+        # (m, n_vert) host copy of each vertex buffer.
+        self.frames = frame_slot((self.m, n)) if frames is None else frames
+        self.uploaded = 0
+        self.y = [np.zeros((self.m, self.n_vert), dtype=np.float32) for i in range(2)]
+
+        # Color of each vertex (TODO: make it more efficient by using a GLSL-based
+        # color map and the index).
+        self.color = np.repeat(np.random.uniform(size=(self.m, 3), low=.5, high=.9),
+                          self.n_vert, axis=0).astype(np.float32)
+
+        # Signal 2D index of each vertex (row and col) and x-index (column
+        # within each signal).
+        x_index = np.arange(self.n_vert) // 2 if self.decimate else np.arange(n)
+        self.index = np.c_[np.repeat(np.repeat(np.arange(ncols), nrows), self.n_vert),
+                      np.repeat(np.tile(np.arange(nrows), ncols), self.n_vert),
+                      np.tile(x_index, self.m)].astype(np.float32)
+
+        # Two vertex buffers: a new frame is uploaded into the one not being
+        # drawn, which then takes over.
+        self.buffers = [gloo.VertexBuffer(y.reshape(-1, 1)) for y in self.y]
+        self.front = 0
+
+        self.program = gloo.Program(VERT_SHADER, FRAG_SHADER)
+        self.program['a_position'] = self.buffers[self.front]
+        self.program['a_color'] = self.color
+        self.program['a_index'] = self.index
+        self.program['u_scale'] = (1., 1.)
+        self.program['u_size'] = (nrows, ncols)
+        self.program['u_n'] = self.n_x
+
+        gloo.set_viewport(0, 0, *self.physical_size)
+
+        # Uploads happen on this timer only, so at most max_fps a second
+        self._timer = app.Timer(1.0 / max_fps, connect=self.on_timer, start=True)
+
+        gloo.set_state(clear_color='black', blend=True,
+                       blend_func=('src_alpha', 'one_minus_src_alpha'))
+        self.show()
+
+    def set_frame(self, frame, y):
+        """ Turn (m, n) samples into (m, n_vert) vertices, decimating them if needed """
+        if self.decimate:
+            envelope(frame, self.n_x, out=y.reshape(self.m, self.n_x, 2))
+        else:
+            y[:] = frame
+
+    def on_resize(self, event):
+        gloo.set_viewport(0, 0, *event.physical_size)
+
+    def on_mouse_wheel(self, event):
+        dx = np.sign(event.delta[1]) * .05
+        scale_x, scale_y = self.program['u_scale']
+        scale_x_new, scale_y_new = (scale_x * math.exp(2.5*dx),
+                                    scale_y * math.exp(0.0*dx))
+        self.program['u_scale'] = (max(1, scale_x_new), max(1, scale_y_new))
+        self.update()
+
+    def on_timer(self, event):
+        seq, frame = self.frames.latest_frame()
+        if seq == self.uploaded:
+            return
+        back = 1 - self.front
+        self.set_frame(frame, self.y[back])
+        if self.frames.overwritten(seq):
+            # The writer lapped us mid-copy: drop it and take a newer frame next tick
+            return
+        self.uploaded = seq
+        self.buffers[back].set_data(self.y[back].reshape(-1, 1))
+        self.program['a_position'] = self.buffers[back]
+        self.front = back
+        self.update()
+
+    def on_draw(self, event):
+        gloo.clear()
+        self.program.draw('line_strip')
+
+
+class WaterfallCanvas(app.Canvas):
+    """
+    Draws the rows of a row_ring of (m, n_x) power spectra as a waterfall per signal.
+    The texture holds one tile of n_history rows per signal and is written
+    as a circular buffer: new rows are uploaded in place and the shader
+    scrolls by the u_offset of the newest row.
+    """
+    def __init__(self, nrows=8, ncols=8, n_x=512, rows=None, max_fps=30):
+        app.Canvas.__init__(self, title='Waterfall', keys='interactive')
+        self.nrows = nrows
+        self.ncols = ncols
+        self.m = nrows*ncols
+        self.n_x = n_x
+        self.rows = row_ring(256, (self.m, n_x)) if rows is None else rows
+        self.n_history = self.rows.n_rows
+        self.uploaded = 0
+        self.clim = None
+
+        self.texture = gloo.Texture2D(
+            np.zeros((nrows * self.n_history, ncols * n_x), dtype=np.float32),
+            format='luminance', internalformat='r32f', interpolation='nearest')
+
+        self.program = gloo.Program(WATERFALL_VERT_SHADER, WATERFALL_FRAG_SHADER)
+        self.program['a_position'] = np.array([[-1, -1], [1, -1], [-1, 1], [1, 1]], dtype=np.float32)
+        self.program['u_texture'] = self.texture
+        self.program['u_size'] = (nrows, ncols)
+        self.program['u_n_history'] = self.n_history
+        self.program['u_offset'] = 0.
+        self.program['u_clim'] = (0., 1.)
+
+        gloo.set_viewport(0, 0, *self.physical_size)
+
+        # Uploads happen on this timer only, so at most max_fps a second
+        self._timer = app.Timer(1.0 / max_fps, connect=self.on_timer, start=True)
+
+        gloo.set_state(clear_color='black')
+        self.show()
+
+    def on_resize(self, event):
+        gloo.set_viewport(0, 0, *event.physical_size)
+
+    def on_timer(self, event):
+        written = self.rows.written
+        if written == self.uploaded:
+            return
+        for seq, r0, r1 in self.rows.runs(self.uploaded, written):
+            # Signal j is drawn in table column j // nrows and row j % nrows, so
+            # reorder the (n, m, n_x) rows into one (n, ncols * n_x) strip per table row
+            tiles = self.rows.rows[r0:r1].reshape(r1 - r0, self.ncols, self.nrows, self.n_x)
+            tiles = tiles.transpose(2, 0, 1, 3).reshape(self.nrows, r1 - r0, self.ncols * self.n_x)
+            if self.rows.overwritten(seq):
+                # The writer lapped us mid-copy: these rows are lost
+                continue
+            for i in range(self.nrows):
+                self.texture.set_data(tiles[i], offset=(i * self.n_history + r0, 0))
+            self.set_clim(tiles)
+        self.uploaded = written
+        self.program['u_offset'] = float(written % self.n_history)
+        self.update()
+
+    def set_clim(self, tiles):
+        """ Follow the range of the incoming levels, smoothed over updates """
+        clim = np.array([tiles.min(), tiles.max()])
+        if self.clim is None:
+            self.clim = clim
+        else:
+            self.clim = 0.9 * self.clim + 0.1 * clim
+        self.program['u_clim'] = (self.clim[0], max(self.clim[1], self.clim[0] + 1e-3))
+
+    def on_draw(self, event):
+        gloo.clear()
+        self.program.draw('triangle_strip')
+
+
+if __name__=="__main__":
+    canvas = Canvas(nrows=2, ncols=2, n=1024)
+    app.run()
+    for i in range(100):
+        canvas.on_run(None)
+
+        app.process_events()
+        #canvas.events.draw()
\ No newline at end of file
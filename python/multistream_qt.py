@@ -18,163 +18,26 @@
 # the Free Software Foundation, Inc., 51 Franklin Street,
 # Boston, MA 02110-1301, USA.
 # 
-from vispy import gloo
-from vispy import app
+import threading
 import numpy as np
 from gnuradio import gr
-import math
-
-VERT_SHADER = """
-#version 120
-
-// y coordinate of the position.
-attribute float a_position;
-
-// row, col, and time index.
-attribute vec3 a_index;
-varying vec3 v_index;
-
-// 2D scaling factor (zooming).
-uniform vec2 u_scale;
-
-// Size of the table.
-uniform vec2 u_size;
-
-// Number of samples per signal.
-uniform float u_n;
-
-// Color.
-attribute vec3 a_color;
-varying vec4 v_color;
-
-// Varying variables used for clipping in the fragment shader.
-varying vec2 v_position;
-varying vec4 v_ab;
-
-void main() {
-    float nrows = u_size.x;
-    float ncols = u_size.y;
-
-    // Compute the x coordinate from the time index.
-    float x = -1 + 2*a_index.z / (u_n-1);
-    vec2 position = vec2(x - (1 - 1 / u_scale.x), a_position);
-
-    // Find the affine transformation for the subplots.
-    vec2 a = vec2(1./ncols, 1./nrows)*.9;
-    vec2 b = vec2(-1 + 2*(a_index.x+.5) / ncols,
-                  -1 + 2*(a_index.y+.5) / nrows);
-    // Apply the static subplot transformation + scaling.
-    gl_Position = vec4(a*u_scale*position+b, 0.0, 1.0);
-
-    v_color = vec4(a_color, 1.);
-    v_index = a_index;
-
-    // For clipping test in the fragment shader.
-    v_position = gl_Position.xy;
-    v_ab = vec4(a, b);
-}
-"""
-
-FRAG_SHADER = """
-#version 120
-
-varying vec4 v_color;
-varying vec3 v_index;
-
-varying vec2 v_position;
-varying vec4 v_ab;
-
-void main() {
-    gl_FragColor = v_color;
-
-    // Discard the fragments between the signals (emulate glMultiDrawArrays).
-    if ((fract(v_index.x) > 0.) || (fract(v_index.y) > 0.))
-        discard;
-
-    // Clipping test.
-    vec2 test = abs((v_position.xy-v_ab.zw)/v_ab.xy);
-    if ((test.x > 1) || (test.y > 1))
-        discard;
-}
-"""
-
-
-class Canvas(app.Canvas):
-    def __init__(self,nrows=8,ncols=8, n=1000, streamer=None):
-        app.Canvas.__init__(self, title='Use your wheel to zoom!',
-                            keys='interactive')
-        self.streamer = streamer
-        # Number of cols and rows in the table.
-        self.nrows = nrows
-        self.ncols = ncols
-
-        # Number of signals.
-        self.m = nrows*ncols
-
-        # Number of samples per signal.
-        self.n = n
-
-        # Various signal amplitudes.
-        self.amplitudes = .1 + .2 * np.random.rand(self.m, 1).astype(np.float32)
-
-        # Generate the signals as a (m, n) array.
-        self.y = self.amplitudes * np.random.randn(self.m, self.n).astype(np.float32)
-        self.y = np.zeros_like(self.y)
-
-        # Color of each vertex (TODO: make it more efficient by using a GLSL-based
-        # color map and the index).
-        self.color = np.repeat(np.random.uniform(size=(self.m, 3), low=.5, high=.9),
-                          self.n, axis=0).astype(np.float32)
-
-        # Signal 2D index of each vertex (row and col) and x-index (sample index
-        # within each signal).
-        self.index = np.c_[np.repeat(np.repeat(np.arange(ncols), nrows), n),
-                      np.repeat(np.tile(np.arange(nrows), ncols), n),
-                      np.tile(np.arange(n), self.m)].astype(np.float32)
-
-        self.program = gloo.Program(VERT_SHADER, FRAG_SHADER)
-        self.program['a_position'] = self.y.reshape(-1, 1)
-        self.program['a_color'] = self.color
-        self.program['a_index'] = self.index
-        self.program['u_scale'] = (1., 1.)
-        self.program['u_size'] = (nrows, ncols)
-        self.program['u_n'] = n
-
-        gloo.set_viewport(0, 0, *self.physical_size)
-
-        self._timer = app.Timer('auto', connect=self.on_timer, start=False)
-
-        gloo.set_state(clear_color='black', blend=True,
-                       blend_func=('src_alpha', 'one_minus_src_alpha'))
-        self.show()
-
-    def on_resize(self, event):
-        gloo.set_viewport(0, 0, *event.physical_size)
-
-    def on_mouse_wheel(self, event):
-        dx = np.sign(event.delta[1]) * .05
-        scale_x, scale_y = self.program['u_scale']
-        scale_x_new, scale_y_new = (scale_x * math.exp(2.5*dx),
-                                    scale_y * math.exp(0.0*dx))
-        self.program['u_scale'] = (max(1, scale_x_new), max(1, scale_y_new))
-        self.update()
-
-    def on_timer(self, event):
-        self.program['a_position'].set_data(self.y.ravel().astype(np.float32))
-        self.update()
-        print("success2", np.sum(self.y))
-        
-
-    def on_draw(self, event):
-        gloo.clear()
-        self.program.draw('line_strip')
+from utils import rebin_freq
 
 
 class multistream_qt(gr.sync_block):
     """
-    docstring for block multistream_qt
+    Plots m vector streams in an nrows by ncols grid.
+    In 'lines' mode the real part of the newest vector of each stream is
+    drawn, at up to max_fps frames a second; vectors longer than n_pixels are
+    drawn as a min/max envelope.
+    In 'waterfall' mode the power spectra of n_avg vectors at a time are
+    averaged into a row, in dB, down to at most n_pixels bins, and the last
+    n_history rows of each stream are drawn as a waterfall.
+    The display runs its own event loop on a separate thread and drops frames
+    it cannot keep up with, so it never slows down the flowgraph.
     """
-    def __init__(self, nrows, ncols, n, m):
+    def __init__(self, nrows, ncols, n, m, n_pixels=512, max_fps=30,
+                 mode='lines', n_history=256, n_avg=1):
         self.nrows = nrows
         self.ncols = ncols
         self.m = m
@@ -183,26 +46,72 @@ class multistream_qt(gr.sync_block):
             name="multistream_qt",
             in_sig=[(np.complex64, n)]*self.m,
             out_sig=None)
-        self.canvas = Canvas(nrows=nrows, ncols=ncols, n=n, streamer=self)
+        self.n = n
+        self.n_pixels = n_pixels
+        self.max_fps = max_fps
+        self.mode = mode
+        # vispy is only imported once a display is created
+        from multistream_canvas import frame_slot, row_ring
+        if mode == 'waterfall':
+            self.n_x = min(n, n_pixels)
+            self.n_avg = n_avg
+            self.n_acc = 0
+            self.power = np.zeros((self.m, n), dtype=np.float32)
+            self.rows = row_ring(n_history, (self.m, self.n_x))
+        elif mode == 'lines':
+            self.frames = frame_slot((self.m, n))
+        else:
+            raise ValueError("multistream_qt: unknown mode %s" % mode)
+        self.canvas = None
+        self.display = threading.Thread(target=self.run_display, name="multistream_qt_display")
+        self.display.daemon = True
+        self.display.start()
+
+    def run_display(self):
+        # The canvas has to be created on the thread that runs its event loop
+        from multistream_canvas import Canvas, WaterfallCanvas, app
+        if self.mode == 'waterfall':
+            self.canvas = WaterfallCanvas(nrows=self.nrows, ncols=self.ncols, n_x=self.n_x,
+                                          rows=self.rows, max_fps=self.max_fps)
+        else:
+            self.canvas = Canvas(nrows=self.nrows, ncols=self.ncols, n=self.n, streamer=self,
+                                 n_pixels=self.n_pixels, max_fps=self.max_fps, frames=self.frames)
         app.run()
-        print("initialized")
 
     def work(self, input_items, output_items):
-        steps = input_items[0].shape[0]
-        for i in range(steps):
+        if self.mode == 'waterfall':
+            return self.work_waterfall(input_items)
+        # Older vectors in this call could never be seen, so only the newest is drawn
+        frame = self.frames.begin_write()
+        for j in range(self.m):
+            frame[j] = input_items[j][-1].real
+        self.frames.end_write()
+        return len(input_items[0])
+
+    def work_waterfall(self, input_items):
+        n_items = len(input_items[0])
+        i = 0
+        while i < n_items:
+            # Sum the power spectra of up to n_avg vectors of each stream at once
+            k = min(n_items - i, self.n_avg - self.n_acc)
             for j in range(self.m):
-                print(self.m, self.canvas.y.shape, input_items[0].shape)
-                self.canvas.y[j] = input_items[j][i].real
-            print(np.sum(self.canvas.y))
-            print("success", self.canvas.y[0][0])
-        return input_items[0].size
-
-
-if __name__=="__main__":
-    canvas = Canvas(nrows=2, ncols=2, n=1024)
-    app.run()
-    for i in range(100):
-        canvas.on_run(None)
-
-        app.process_events()
-        #canvas.events.draw()
\ No newline at end of file
+                spectra = np.fft.fft(input_items[j][i:i + k], axis=1)
+                self.power[j] += np.sum(spectra.real ** 2 + spectra.imag ** 2, axis=0)
+            self.n_acc += k
+            i += k
+            if self.n_acc == self.n_avg:
+                self.add_row()
+        return n_items
+
+    def add_row(self):
+        """ Turn the summed power spectra into a row of averages in dB """
+        row = self.rows.begin_write()
+        power = np.fft.fftshift(self.power, axes=1)
+        rebin_freq(power, self.n_x, out=row)
+        row /= self.n_avg
+        np.maximum(row, 1e-20, out=row)
+        np.log10(row, out=row)
+        row *= 10
+        self.rows.end_write()
+        self.power[:] = 0
+        self.n_acc = 0
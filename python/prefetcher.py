@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 
+# Copyright 2019 <+YOU OR YOUR COMPANY+>.
+# 
+# This is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+# 
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this software; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street,
+# Boston, MA 02110-1301, USA.
+# 
+
+
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class slot_prefetcher(object):
+    """
+    Runs load ahead of the consumer on a pool of worker threads.
+    Item number seq of the stream is loaded by load(seq, slot), which fills
+    slot seq % n_slots of a ring of buffers the caller preallocates and
+    returns what next() should hand out for it, or None at the end of the
+    stream. Items come out in order without copies; a slot is refilled
+    once the consumer asks for the item after it.
+    """
+    def __init__(self, load, n_slots, n_threads=1, name="prefetch"):
+        self.load = load
+        self.n_slots = n_slots
+        self.results = [None] * n_slots
+        self.errors = [None] * n_slots
+        self.ready = [threading.Event() for i in range(n_slots)]
+        self.jobs = queue.Queue()
+        self.seq = 0
+        # The item to refill the slot of on the next call, and how the stream ended
+        self.refill = None
+        self.finished = False
+        self.error = None
+        self.threads = []
+        for i in range(n_threads):
+            thread = threading.Thread(target=self._worker, name="%s_%d" % (name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        for seq in range(n_slots):
+            self._submit(seq)
+
+    def _submit(self, seq):
+        self.ready[seq % self.n_slots].clear()
+        self.jobs.put(seq)
+
+    def _worker(self):
+        while True:
+            seq = self.jobs.get()
+            if seq is None:
+                return
+            slot = seq % self.n_slots
+            self.results[slot] = None
+            try:
+                self.results[slot] = self.load(seq, slot)
+            except Exception as e:
+                self.errors[slot] = e
+            self.ready[slot].set()
+
+    def next(self):
+        """
+        Wait for the next item of the stream, and return what load returned
+        for it. Its slot is only valid until the following call.
+        Once the stream has ended, or a load has raised, every later call
+        returns None or raises that error again.
+        """
+        if self.error is not None:
+            raise self.error
+        if self.finished:
+            return None
+        if self.refill is not None:
+            # The consumer is done with the previous item, refill its slot
+            self._submit(self.refill + self.n_slots)
+            self.refill = None
+        slot = self.seq % self.n_slots
+        self.ready[slot].wait()
+        if self.errors[slot] is not None:
+            self.error, self.errors[slot] = self.errors[slot], None
+            raise self.error
+        if self.results[slot] is None:
+            self.finished = True
+            return None
+        self.refill = self.seq
+        self.seq += 1
+        return self.results[slot]
+
+    def stop(self):
+        for thread in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
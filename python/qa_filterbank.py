@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 
+# Copyright 2019 <+YOU OR YOUR COMPANY+>.
+# 
+# This is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+# 
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this software; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street,
+# Boston, MA 02110-1301, USA.
+# 
+
+
+import os
+import shutil
+import tempfile
+import numpy as np
+from gnuradio import gr_unittest
+from filterbank import Filterbank, FilterbankWriter, sigproc_header_from_guppi
+
+HEADER = {'nchans': 6, 'fch1': 1500.0, 'foff': -0.5, 'tsamp': 1.5,
+          'tstart': 57386.25, 'source_name': 'VOYAGER1', 'telescope_id': 6}
+
+
+class qa_filterbank (gr_unittest.TestCase):
+
+    def setUp (self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown (self):
+        shutil.rmtree(self.dir)
+
+    def test_001_writer_round_trip (self):
+        filename = os.path.join(self.dir, 'a.fil')
+        rows = np.random.RandomState(0).rand(50, 6).astype(np.float32)
+        # A buffer of 4 rows: batches below, across and above its size
+        with FilterbankWriter(filename, HEADER, buffer_size=4 * 6 * 4) as writer:
+            for start, stop in ((0, 1), (1, 3), (3, 10), (10, 11), (11, 30), (30, 50)):
+                writer.write_rows(rows[start:stop])
+            self.assertEqual(writer.n_rows, 50)
+        reader = Filterbank(filename)
+        for key, val in HEADER.items():
+            self.assertEqual(reader.header[key], val)
+        self.assertEqual(reader.header['nbits'], 32)
+        self.assertEqual(reader.header['nifs'], 1)
+        self.assertEqual(reader.n_ints_in_file, 50)
+        self.assertTrue(np.array_equal(reader.read_rows(0, 50), rows))
+        self.assertFloatTuplesAlmostEqual(reader.freqs, 1500.0 - 0.5 * np.arange(6))
+
+    def test_002_writer_casts_rows (self):
+        filename = os.path.join(self.dir, 'a.fil')
+        rows = np.arange(24, dtype=np.float64).reshape(4, 1, 6)
+        with FilterbankWriter(filename, dict(HEADER, nbits=8), buffer_size=6) as writer:
+            writer.write_rows(rows)
+        reader = Filterbank(filename)
+        self.assertEqual(reader.data.dtype, np.uint8)
+        self.assertTrue(np.array_equal(reader.read_rows(0, 4), rows[:, 0]))
+
+    def test_003_sigproc_header_from_guppi (self):
+        guppi_header = {'OBSNCHAN': 4, 'OBSFREQ': 1500.5, 'OBSBW': -187.5, 'TBIN': 2.0e-6,
+                        'STT_IMJD': 57386, 'STT_SMJD': 21600, 'STT_OFFS': 0.0,
+                        'SRC_NAME': 'VOYAGER1', 'RA_STR': '17:10:03.98', 'DEC_STR': '-05:03:15.5'}
+        header = sigproc_header_from_guppi(guppi_header, n_fft=16, n_int=4)
+        self.assertEqual(header['nchans'], 64)
+        self.assertAlmostEqual(header['foff'], -187.5 / 64)
+        self.assertAlmostEqual(header['tsamp'], 2.0e-6 * 16 * 4)
+        self.assertAlmostEqual(header['tstart'], 57386.25)
+        self.assertAlmostEqual(header['src_raj'], 171003.98)
+        self.assertAlmostEqual(header['src_dej'], -50315.5)
+        # The center bin of every coarse channel is at its center frequency
+        freqs = header['fch1'] + header['foff'] * np.arange(64)
+        centers = 1500.5 + (np.arange(4) - 1.5) * -46.875
+        self.assertFloatTuplesAlmostEqual(freqs[8::16], centers)
+
+
+if __name__ == '__main__':
+    gr_unittest.run(qa_filterbank, "qa_filterbank.xml")
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 
+# Copyright 2019 <+YOU OR YOUR COMPANY+>.
+# 
+# This is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+# 
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this software; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street,
+# Boston, MA 02110-1301, USA.
+# 
+
+
+import os
+import shutil
+import tempfile
+import numpy as np
+from gnuradio import gr_unittest
+from guppi import (GuppiRaw, GuppiRawSequence, GuppiRawWriter, extract, channel_selection,
+                   parse_header_card, format_header_card, DIRECTIO_ALIGN, INDEX_SUFFIX, MJD_UNIX_EPOCH)
+
+N_CHAN = 4
+N_TIME = 32
+TBIN = 2.0e-6
+
+
+def make_header(pktidx, **extra):
+    header = {'BACKEND': 'GUPPI', 'TELESCOP': 'GBT', 'SRC_NAME': 'VOYAGER1',
+              'OBSNCHAN': N_CHAN, 'NPOL': 4, 'NBITS': 8, 'OBSFREQ': 1500.5,
+              'OBSBW': -187.5, 'CHAN_BW': -46.875, 'TBIN': TBIN,
+              'STT_IMJD': 57386, 'STT_SMJD': 3600, 'STT_OFFS': 0.0,
+              'PKTIDX': pktidx, 'PIPERBLK': N_TIME}
+    header.update(extra)
+    return header
+
+
+def make_blocks(n_blocks, seed=0):
+    rng = np.random.RandomState(seed)
+    return [rng.randint(-128, 128, (N_CHAN, N_TIME, 4)).astype(np.int8) for i in range(n_blocks)]
+
+
+class qa_guppi (gr_unittest.TestCase):
+
+    def setUp (self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown (self):
+        shutil.rmtree(self.dir)
+
+    def write_file (self, name, blocks, first_block=0, directio=True, pktidx=None, **extra):
+        """ Write consecutive blocks from first_block, or with the given PKTIDX, and extra header fields """
+        if pktidx is None:
+            pktidx = [(first_block + i) * N_TIME for i in range(len(blocks))]
+        filename = os.path.join(self.dir, name)
+        with GuppiRawWriter(filename, directio=directio) as writer:
+            for idx, data in zip(pktidx, blocks):
+                writer.write_block(make_header(idx, **extra), data)
+        return filename
+
+    def test_001_writer_round_trip (self):
+        blocks = make_blocks(3)
+        reader = GuppiRaw(self.write_file('a.raw', blocks))
+        self.assertEqual(reader.find_n_data_blocks(), 3)
+        self.assertTrue(np.array_equal(reader.index['pktidx'], [0, N_TIME, 2 * N_TIME]))
+        self.assertTrue(np.array_equal(reader.index['blocsize'], [N_CHAN * N_TIME * 4] * 3))
+        # Headers are padded so every data block starts DIRECTIO aligned
+        self.assertTrue((reader.index['data_idx'] % DIRECTIO_ALIGN == 0).all())
+        header = reader.read_first_header()
+        self.assertEqual(header['DIRECTIO'], 1)
+        self.assertEqual(header['OBSNCHAN'], N_CHAN)
+        self.assertEqual(header['OBSFREQ'], 1500.5)
+        self.assertTrue(isinstance(header['OBSFREQ'], float))
+        self.assertTrue(isinstance(header['STT_IMJD'], int))
+        self.assertEqual(header['SRC_NAME'], 'VOYAGER1')
+        for i, data in enumerate(blocks):
+            h, data_x, data_y = reader.read_block_channels(i)
+            self.assertTrue(np.array_equal(data_x, data[..., 0:2]))
+            self.assertTrue(np.array_equal(data_y, data[..., 2:4]))
+
+    def test_002_writer_without_directio (self):
+        blocks = make_blocks(2)
+        reader = GuppiRaw(self.write_file('a.raw', blocks, directio=False))
+        self.assertEqual(reader.find_n_data_blocks(), 2)
+        self.assertEqual(reader.read_first_header()['DIRECTIO'], 0)
+        # Without padding, data follows the END card of each header directly
+        header_len = reader.index['data_idx'][0] - reader.index['header_idx'][0]
+        self.assertEqual(header_len % 80, 0)
+        self.assertEqual(reader.index['header_idx'][1], reader.index['data_idx'][0] + blocks[0].nbytes)
+        self.assertTrue(np.array_equal(reader.read_block_raw(1)[1].ravel(), blocks[1].view(np.int8).ravel()))
+
+    def test_003_write_block_int8 (self):
+        blocks = make_blocks(1)
+        filename = os.path.join(self.dir, 'a.raw')
+        with GuppiRawWriter(filename) as writer:
+            writer.write_block_int8(make_header(0), blocks[0][..., 0:2], blocks[0][..., 2:4])
+        h, data_x, data_y = GuppiRaw(filename).read_block_channels(0)
+        self.assertTrue(np.array_equal(data_x, blocks[0][..., 0:2]))
+        self.assertTrue(np.array_equal(data_y, blocks[0][..., 2:4]))
+
+    def test_004_sequence (self):
+        blocks = make_blocks(5)
+        self.write_file('scan.0000.raw', blocks[:3])
+        self.write_file('scan.0001.raw', blocks[3:], first_block=3)
+        reader = GuppiRawSequence(os.path.join(self.dir, 'scan.0000.raw'))
+        self.assertEqual(reader.find_n_data_blocks(), 5)
+        self.assertTrue(np.array_equal(reader.index['file_idx'], [0, 0, 0, 1, 1]))
+        self.assertEqual(reader.find_dropped_blocks(), [])
+        for i, data in enumerate(blocks):
+            h, data_x, data_y = reader.read_block_channels(i)
+            self.assertEqual(h['PKTIDX'], i * N_TIME)
+            self.assertTrue(np.array_equal(data_x, data[..., 0:2]))
+
+    def test_005_extract_channels (self):
+        blocks = make_blocks(4)
+        filename = self.write_file('a.raw', blocks)
+        out_filename = os.path.join(self.dir, 'b.raw')
+        self.assertEqual(extract(filename, out_filename, chans=slice(1, 3)), 4)
+        reader = GuppiRaw(out_filename)
+        header = reader.read_first_header()
+        self.assertEqual(header['OBSNCHAN'], 2)
+        self.assertEqual(header['BLOCSIZE'], 2 * N_TIME * 4)
+        self.assertAlmostEqual(header['OBSFREQ'], 1500.5)
+        self.assertAlmostEqual(header['OBSBW'], -93.75)
+        for i, data in enumerate(blocks):
+            h, data_x, data_y = reader.read_block_channels(i)
+            self.assertTrue(np.array_equal(data_x, data[1:3, :, 0:2]))
+            self.assertTrue(np.array_equal(data_y, data[1:3, :, 2:4]))
+        # Non-consecutive channels can't be described by the header
+        self.assertRaises(ValueError, extract, filename, out_filename, [0, 2])
+
+    def test_006_extract_time_window (self):
+        blocks = make_blocks(4)
+        filename = self.write_file('scan.0000.raw', blocks)
+        out_filename = os.path.join(self.dir, 'b.raw')
+        tbin = make_header(0)['TBIN']
+        # Whole blocks from the one holding start_time to the one holding stop_time
+        self.assertEqual(extract(filename, out_filename, start_time=1.5 * N_TIME * tbin,
+                                 stop_time=2.5 * N_TIME * tbin), 2)
+        reader = GuppiRaw(out_filename)
+        self.assertTrue(np.array_equal(reader.index['pktidx'], [N_TIME, 2 * N_TIME]))
+        self.assertTrue(np.array_equal(reader.read_block_channels(0)[1], blocks[1][..., 0:2]))
+
+    def test_007_index_sidecar (self):
+        filename = self.write_file('a.raw', make_blocks(3))
+        reader = GuppiRaw(filename)
+        self.assertEqual(reader.n_blocks, 3)
+        self.assertTrue(os.path.exists(filename + INDEX_SUFFIX))
+        # The sidecar is used as long as the file is unchanged...
+        reader.build_index = None
+        self.assertEqual(reader.load_index()[1], reader.headers)
+        # ...and rebuilt when it changes
+        self.write_file('a.raw', make_blocks(4))
+        self.assertEqual(GuppiRaw(filename).n_blocks, 4)
+        self.assertEqual(GuppiRaw(filename).headers[3]['PKTIDX'], 3 * N_TIME)
+        os.remove(filename + INDEX_SUFFIX)
+        self.assertEqual(GuppiRaw(filename, cache_index=False).n_blocks, 4)
+        self.assertFalse(os.path.exists(filename + INDEX_SUFFIX))
+
+    def test_008_header_types (self):
+        cards = [(b"OBSNCHAN=                   64", 'OBSNCHAN', 64),
+                 (b"OBSFREQ =                 1500", 'OBSFREQ', 1500.0),
+                 (b"NPKT    =              1.6E+04", 'NPKT', 16000),
+                 (b"SRC_NAME= 'VOYAGER1'", 'SRC_NAME', 'VOYAGER1'),
+                 (b"PROJID  =                 1234", 'PROJID', '1234'),
+                 (b"MYFLOAT =                  2.5", 'MYFLOAT', 2.5),
+                 (b"MYINT   =                    7", 'MYINT', 7)]
+        for card, key, val in cards:
+            parsed = parse_header_card(card.ljust(80))
+            self.assertEqual(parsed, (key, val))
+            self.assertEqual(type(parsed[1]), type(val))
+        for key, val in (('TBIN', 1e-05), ('OBSBW', -187.5), ('PKTIDX', 123456), ('SRC_NAME', 'B0329+54')):
+            self.assertEqual(parse_header_card(format_header_card(key, val)), (key, val))
+
+
+    def test_009_sequence_dropped_blocks (self):
+        blocks = make_blocks(4)
+        self.write_file('scan.0000.raw', blocks[:2])
+        # The block with PKTIDX 2 * N_TIME was dropped
+        self.write_file('scan.0001.raw', blocks[2:], first_block=3)
+        reader = GuppiRawSequence(os.path.join(self.dir, 'scan.0000.raw'))
+        self.assertEqual(reader.find_n_data_blocks(), 4)
+        self.assertEqual(reader.find_dropped_blocks(), [(2, 1)])
+        self.assertTrue(np.array_equal(reader.block_sample_offsets(), np.array([0, 1, 3, 4]) * N_TIME))
+        self.assertTrue(np.array_equal(reader.read_block_channels(2)[1], blocks[2][..., 0:2]))
+
+
+    def test_010_read_block_channels (self):
+        blocks = make_blocks(2)
+        reader = GuppiRaw(self.write_file('a.raw', blocks))
+        header, data_x, data_y = reader.read_block_channels(1, slice(1, 3))
+        self.assertTrue(np.array_equal(data_x, blocks[1][1:3, :, 0:2]))
+        self.assertTrue(np.array_equal(data_y, blocks[1][1:3, :, 2:4]))
+        header, data_x, data_y = reader.read_block_channels(0, [3, 0])
+        self.assertTrue(np.array_equal(data_x, blocks[0][[3, 0], :, 0:2]))
+        self.assertRaises(ValueError, reader.read_block_channels, 0, slice(3, 5))
+
+    def test_011_read_block_channels_chanmaj (self):
+        # CHANMAJ blocks are stored as (sample, channel, pol) but read as (channel, sample, pol)
+        data = make_blocks(1)[0]
+        filename = self.write_file('a.raw', [data.transpose(1, 0, 2)], CHANMAJ=1)
+        header, data_x, data_y = GuppiRaw(filename).read_block_channels(0, [2, 1])
+        self.assertTrue(np.array_equal(data_x, data[[2, 1], :, 0:2]))
+        self.assertTrue(np.array_equal(data_y, data[[2, 1], :, 2:4]))
+
+    def test_012_channel_selection (self):
+        self.assertEqual(channel_selection(None, N_CHAN), slice(0, N_CHAN))
+        self.assertEqual(channel_selection([1, 2, 3], N_CHAN), slice(1, 4))
+        self.assertEqual(channel_selection(2, N_CHAN), slice(2, 3))
+        self.assertTrue(np.array_equal(channel_selection([3, 0], N_CHAN), [3, 0]))
+        for chans in (slice(2, N_CHAN + 1), slice(-1, 2), [0, N_CHAN], -1):
+            self.assertRaises(ValueError, channel_selection, chans, N_CHAN)
+
+
+    def test_013_block_start_times (self):
+        pktidx = np.array([1, 2, 4]) * N_TIME
+        reader = GuppiRaw(self.write_file('a.raw', make_blocks(3), pktidx=pktidx, PKTSTART=0, STT_OFFS=0.25))
+        # Sample offsets count from the first block and keep the gap left by the dropped block
+        self.assertTrue(np.array_equal(reader.block_sample_offsets(), [0, N_TIME, 3 * N_TIME]))
+        secs, frac = reader.block_start_times()
+        # STT_* is the time of PKTSTART, so the first block starts N_TIME samples later
+        t0 = (57386 - MJD_UNIX_EPOCH) * 86400 + 3600
+        self.assertTrue(np.array_equal(secs, [t0] * 3))
+        self.assertFloatTuplesAlmostEqual(frac, 0.25 + pktidx * TBIN)
+
+
+    def test_014_read_block_view (self):
+        blocks = make_blocks(2)
+        reader = GuppiRaw(self.write_file('a.raw', blocks), use_mmap=True)
+        header, data_x, data_y = reader.read_block_view(1, 1, 2)
+        self.assertTrue(np.array_equal(data_x, blocks[1][1:3, :, 0:2]))
+        self.assertTrue(np.array_equal(data_y, blocks[1][1:3, :, 2:4]))
+        # Views into the file pages, not copies
+        self.assertTrue(np.shares_memory(data_x, reader._get_mmap()))
+        self.assertFalse(data_x.flags.writeable)
+        header, data = reader.read_block_raw(0, slice(2, 4))
+        self.assertTrue(np.shares_memory(data, reader._get_mmap()))
+        self.assertTrue(np.array_equal(data.reshape(2, N_TIME, 4), blocks[0][2:4]))
+
+
+if __name__ == '__main__':
+    gr_unittest.run(qa_guppi, "qa_guppi.xml")
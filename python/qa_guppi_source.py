@@ -19,22 +19,102 @@
 # Boston, MA 02110-1301, USA.
 # 
 
+
+import os
+import shutil
+import tempfile
+import numpy as np
 from gnuradio import gr, gr_unittest
 from gnuradio import blocks
+from guppi import GuppiRawWriter
 from guppi_source import guppi_source
+from qa_guppi import N_CHAN, N_TIME, TBIN, make_header, make_blocks
+
+
+def to_complex(data):
+    """ (..., 2) int8 (real, imag) pairs as complex64 """
+    return (data[..., 0] + 1j * data[..., 1]).astype(np.complex64)
+
 
 class qa_guppi_source (gr_unittest.TestCase):
 
     def setUp (self):
         self.tb = gr.top_block ()
+        self.dir = tempfile.mkdtemp()
 
     def tearDown (self):
         self.tb = None
+        shutil.rmtree(self.dir)
+
+    def write_file (self, name, pktidx, **extra):
+        """ Write blocks of random data with the given PKTIDX; returns the filename and the (n_chan, n_time, 4) blocks """
+        filename = os.path.join(self.dir, name)
+        blocks = make_blocks(len(pktidx))
+        with GuppiRawWriter(filename) as writer:
+            for idx, data in zip(pktidx, blocks):
+                writer.write_block(make_header(idx, **extra), data)
+        return filename, blocks
+
+    def run_source (self, src, nchan):
+        """ Stream src to the end in vector mode; returns (n, nchan, pol) samples """
+        sink = blocks.vector_sink_c(nchan * 2)
+        self.tb.connect(src, sink)
+        self.tb.run()
+        return np.array(sink.data(), dtype=np.complex64).reshape(-1, nchan, 2)
+
+    def test_001_source_vector_output (self):
+        filename, data = self.write_file('a.raw', [0, 32, 64])
+        src = guppi_source(filename, 1, 2, repeat=False, vector_output=True)
+        result = self.run_source(src, 2)
+        expected = np.concatenate([to_complex(d[1:3].reshape(2, N_TIME, 2, 2)) for d in data], axis=1)
+        self.assertTrue(np.array_equal(result, expected.transpose(1, 0, 2)))
+
+    def test_002_source_port_output (self):
+        filename, data = self.write_file('a.raw', [0, 32, 64])
+        src = guppi_source(filename, [3, 1], repeat=False)
+        sinks = [blocks.vector_sink_c() for i in range(4)]
+        for port, sink in enumerate(sinks):
+            self.tb.connect((src, port), sink)
+        self.tb.run()
+        # Ports alternate X and Y polarisation of each selected channel
+        samples = np.concatenate([to_complex(d.reshape(N_CHAN, N_TIME, 2, 2)) for d in data], axis=1)
+        for port, sink in enumerate(sinks):
+            self.assertTrue(np.array_equal(sink.data(), samples[[3, 1][port // 2], :, port % 2]))
+
+    def test_003_source_block_and_time_range (self):
+        filename, data = self.write_file('a.raw', [0, 32, 64, 96])
+        samples = np.concatenate([to_complex(d.reshape(N_CHAN, N_TIME, 2, 2)) for d in data], axis=1)
+        samples = samples.transpose(1, 0, 2)
+        src = guppi_source(filename, 0, N_CHAN, repeat=False, vector_output=True,
+                           start_block=1, stop_block=3)
+        self.assertTrue(np.array_equal(self.run_source(src, N_CHAN), samples[32:96]))
+        self.tb = gr.top_block()
+        src = guppi_source(filename, 0, N_CHAN, repeat=False, vector_output=True, sample_offset=5)
+        src.set_time_range(40 * TBIN, 100 * TBIN)
+        self.assertTrue(np.array_equal(self.run_source(src, N_CHAN), samples[45:100]))
+        # Both times count from the start of start_block
+        self.tb = gr.top_block()
+        src = guppi_source(filename, 0, N_CHAN, repeat=False, vector_output=True,
+                           start_block=1, start_time=8 * TBIN, stop_time=40 * TBIN)
+        self.assertTrue(np.array_equal(self.run_source(src, N_CHAN), samples[40:72]))
+
+    def test_004_source_empty_range (self):
+        filename, data = self.write_file('a.raw', [0, 32])
+        self.assertRaises(ValueError, guppi_source, filename, 0, N_CHAN,
+                          start_time=20 * TBIN, stop_time=10 * TBIN)
+        self.assertRaises(ValueError, guppi_source, filename, 0, N_CHAN, start_block=1, stop_block=1)
+        # A stop before the start set while running ends the stream, even when repeating
+        src = guppi_source(filename, 0, N_CHAN, repeat=True, vector_output=True)
+        src.set_time_range(20 * TBIN, 10 * TBIN)
+        self.assertEqual(len(self.run_source(src, N_CHAN)), 0)
+        with open(os.path.join(self.dir, 'empty.raw'), 'wb'):
+            pass
+        self.assertRaises(ValueError, guppi_source, os.path.join(self.dir, 'empty.raw'))
 
-    def test_001_t (self):
-        # set up fg
-        self.tb.run ()
-        # check data
+    def test_005_source_channels_out_of_range (self):
+        filename, data = self.write_file('a.raw', [0])
+        self.assertRaises(ValueError, guppi_source, filename, 3, 2)
+        self.assertRaises(ValueError, guppi_source, filename, [0, N_CHAN])
 
 
 if __name__ == '__main__':
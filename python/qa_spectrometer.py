@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2019 <+YOU OR YOUR COMPANY+>.
+#
+# This is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street,
+# Boston, MA 02110-1301, USA.
+#
+
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import pmt
+from gnuradio import gr, gr_unittest
+from gnuradio import blocks
+from filterbank import sigproc_header_from_guppi
+from guppi import GuppiRaw, GuppiRawWriter, channel_subset_header
+from spectrometer import spectrometer
+from qa_guppi import N_TIME, TBIN, make_header, make_blocks
+
+
+def power_spectra(x, y, n_fft, n_int):
+    """ Reference rows of the (nchan, n_samples) X and Y voltages, computed the slow way """
+    nchan = x.shape[0]
+    n_rows = x.shape[1] // (n_fft * n_int)
+    power = 0
+    for d in (x, y):
+        frames = d[:, :n_rows * n_int * n_fft].reshape(nchan, n_rows, n_int, n_fft)
+        power = power + (np.abs(np.fft.fft(frames, axis=-1)) ** 2).sum(axis=2)
+    return np.fft.fftshift(power, axes=-1).transpose(1, 0, 2).reshape(n_rows, nchan * n_fft)
+
+
+def make_tag(key, value, offset=0):
+    tag = gr.tag_t()
+    tag.key = pmt.intern(key)
+    tag.value = value
+    tag.offset = offset
+    return tag
+
+
+class qa_spectrometer (gr_unittest.TestCase):
+
+    def setUp (self):
+        self.tb = gr.top_block ()
+        self.dir = tempfile.mkdtemp()
+        self.rng = np.random.RandomState(0)
+
+    def tearDown (self):
+        self.tb = None
+        shutil.rmtree(self.dir)
+
+    def voltages (self, nchan, n_samples):
+        """ Random complex64 X and Y voltages of shape (nchan, n_samples) """
+        shape = (2, nchan, n_samples)
+        return (self.rng.randn(*shape) + 1j * self.rng.randn(*shape)).astype(np.complex64)
+
+    def run_spectrometer (self, spec, sources=()):
+        """ Run sources into spec to the end; returns the output rows and their tags by key """
+        sink = blocks.vector_sink_f(spec.nchan * spec.n_fft)
+        for port, src in enumerate(sources):
+            self.tb.connect(src, (spec, port))
+        self.tb.connect(spec, sink)
+        self.tb.run()
+        rows = np.array(sink.data(), dtype=np.float32).reshape(-1, spec.nchan * spec.n_fft)
+        return rows, dict((pmt.symbol_to_string(tag.key), tag) for tag in sink.tags())
+
+    def test_001_fft_length_and_n_int (self):
+        x, y = self.voltages(2, 1000)
+        # Vectors of (x0, y0, x1, y1) per sample
+        samples = np.stack([x, y], axis=1).reshape(4, -1).T
+        spec = spectrometer(16, 3, nchan=2, vector_input=1)
+        rows, tags = self.run_spectrometer(spec, [blocks.vector_source_c(samples.ravel().tolist(), False, 4)])
+        # 1000 samples make 62 spectra, of which 60 fill 20 rows
+        self.assertEqual(rows.shape, (20, 32))
+        self.assertTrue(np.allclose(rows, power_spectra(x, y, 16, 3), rtol=1e-4))
+        self.assertEqual(tags, {})
+
+    def test_002_fft_shifted_channels (self):
+        # A tone at fine channel k of an n_fft point FFT ends up at n_fft // 2 + k
+        for n_fft in (8, 15):
+            for k in (0, 1, -1, -(n_fft // 2)):
+                self.tb = gr.top_block()
+                tone = np.exp(2j * np.pi * k * np.arange(4 * n_fft) / n_fft).astype(np.complex64)
+                sources = [blocks.vector_source_c(tone.tolist()), blocks.vector_source_c([0j] * len(tone))]
+                rows, tags = self.run_spectrometer(spectrometer(n_fft, 4), sources)
+                self.assertEqual(rows.shape, (1, n_fft))
+                self.assertEqual(int(np.argmax(rows[0])), n_fft // 2 + k)
+                self.assertAlmostEqual(rows[0].max() / (4 * n_fft ** 2), 1.0, places=4)
+
+    def test_003_integration_across_batches (self):
+        x, y = self.voltages(2, 10 * 16)
+        frames = np.stack([x, y]).reshape(2, 2, 10, 16)
+        spec = spectrometer(16, 5, nchan=2)
+        rows = np.zeros((2, 32), dtype=np.float32)
+        # Rows are summed over however many calls their spectra arrive in
+        for start, stop in ((0, 1), (1, 4), (4, 5)):
+            spec.integrate(frames[:, :, start:stop])
+        self.assertEqual(spec.n_acc, 5)
+        spec.output_row(rows[0])
+        self.assertEqual(spec.n_acc, 0)
+        for start, stop in ((5, 7), (7, 10)):
+            spec.integrate(frames[:, :, start:stop])
+        spec.output_row(rows[1])
+        self.assertTrue(np.allclose(rows, power_spectra(x, y, 16, 5), rtol=1e-4))
+
+    def test_004_stream_tags (self):
+        x, y = self.voltages(2, 256)
+        freqs = [1500.0e6, 1502.0e6]
+        sources = []
+        for chan in range(2):
+            tags = [make_tag('rx_freq', pmt.from_double(freqs[chan])),
+                    make_tag('rx_time', pmt.make_tuple(pmt.from_uint64(1500000000), pmt.from_double(0.25)))]
+            sources.append(blocks.vector_source_c(x[chan].tolist(), False, 1, tags))
+            sources.append(blocks.vector_source_c(y[chan].tolist()))
+        spec = spectrometer(8, 2, nchan=2, tbin=0.5e-6)
+        rows, tags = self.run_spectrometer(spec, sources)
+        self.assertTrue(np.allclose(rows, power_spectra(x, y, 8, 2), rtol=1e-4))
+        # The center of each coarse channel is at fine channel n_fft // 2
+        self.assertAlmostEqual(pmt.to_double(tags['foff'].value), 0.25)
+        self.assertAlmostEqual(pmt.to_double(tags['fch1'].value), 1500.0 - 4 * 0.25)
+        self.assertAlmostEqual(pmt.to_double(tags['tsamp'].value), 0.5e-6 * 8 * 2)
+        self.assertEqual(pmt.to_uint64(pmt.tuple_ref(tags['rx_time'].value, 0)), 1500000000)
+        self.assertAlmostEqual(pmt.to_double(pmt.tuple_ref(tags['rx_time'].value, 1)), 0.25)
+        for tag in tags.values():
+            self.assertEqual(tag.offset, 0)
+
+    def test_005_file_input (self):
+        data = make_blocks(3)
+        filename = os.path.join(self.dir, 'a.raw')
+        with GuppiRawWriter(filename) as writer:
+            for i, block in enumerate(data):
+                writer.write_block(make_header(i * N_TIME), block)
+        # Rows of 6 spectra of 8 samples span the blocks of 32 samples
+        spec = spectrometer(8, 6, nchan=2, filename=filename, chan=1)
+        rows, tags = self.run_spectrometer(spec)
+        samples = np.concatenate(data, axis=1)[1:3].astype(np.float32)
+        x = samples[..., 0] + 1j * samples[..., 1]
+        y = samples[..., 2] + 1j * samples[..., 3]
+        self.assertEqual(rows.shape, (2, 16))
+        self.assertTrue(np.allclose(rows, power_spectra(x, y, 8, 6), rtol=1e-4))
+        header = GuppiRaw(filename).read_first_header()
+        header = sigproc_header_from_guppi(channel_subset_header(header, slice(1, 3)), 8, 6)
+        for key in ('fch1', 'foff', 'tsamp'):
+            self.assertAlmostEqual(pmt.to_double(tags[key].value), header[key])
+        self.assertAlmostEqual(header['tsamp'], TBIN * 8 * 6)
+        self.assertIn('rx_time', tags)
+
+
+if __name__ == '__main__':
+    gr_unittest.run(qa_spectrometer, "qa_spectrometer.xml")
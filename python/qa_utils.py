@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 
+# Copyright 2019 <+YOU OR YOUR COMPANY+>.
+# 
+# This is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+# 
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this software; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street,
+# Boston, MA 02110-1301, USA.
+# 
+
+import numpy as np
+from gnuradio import gr_unittest
+from utils import unpack, unpack_2to8, unpack_4to8, unpack_4to_complex64, to_complex64, rebin_freq, envelope
+
+class qa_utils (gr_unittest.TestCase):
+
+    def test_001_unpack_4to8_vectors (self):
+        # (packed byte, high nibble, low nibble)
+        vectors = [(0x00, 0, 0), (0x01, 0, 1), (0x10, 1, 0), (0x7F, 7, -1),
+                   (0x80, -8, 0), (0x88, -8, -8), (0xF8, -1, -8), (0xFF, -1, -1),
+                   (0x19, 1, -7), (0xA6, -6, 6), (0x5C, 5, -4), (0xE3, -2, 3)]
+        data = np.array([v[0] for v in vectors], dtype=np.uint8)
+        expected = np.array([v[1:] for v in vectors], dtype=np.int8).ravel()
+        result = unpack_4to8(data)
+        self.assertEqual(result.dtype, np.int8)
+        self.assertTrue(np.array_equal(result, expected))
+        self.assertTrue(np.array_equal(unpack(data.view(np.int8), 4), expected))
+
+    def test_002_unpack_4to8_all_bytes (self):
+        data = np.arange(256, dtype=np.uint8).reshape(16, 16)
+        high = (data >> 4).astype(np.int16)
+        low = (data & 0xF).astype(np.int16)
+        high[high >= 8] -= 16
+        low[low >= 8] -= 16
+        expected = np.stack([high, low], axis=-1).reshape(16, 32)
+        self.assertTrue(np.array_equal(unpack_4to8(data), expected))
+
+    def test_003_unpack_4to_complex64 (self):
+        data = np.array([0x7F, 0x80, 0x19, 0xE3], dtype=np.uint8)
+        expected = np.array([7 - 1j, -8 + 0j, 1 - 7j, -2 + 3j], dtype=np.complex64)
+        self.assertComplexTuplesAlmostEqual(unpack_4to_complex64(data), expected)
+        out = np.zeros((4, 3), dtype=np.complex64)
+        unpack_4to_complex64(data, out[:, 1])
+        self.assertComplexTuplesAlmostEqual(out[:, 1], expected)
+        self.assertComplexTuplesAlmostEqual(to_complex64(data, nbit=4, scale=0.5), expected * 0.5)
+
+    def test_004_unpack_2to8_vectors (self):
+        data = np.array([0x00, 0xFF, 0x1B, 0xE4], dtype=np.uint8)
+        expected = np.array([40, 40, 40, 40, -40, -40, -40, -40,
+                             40, 12, -12, -40, -40, -12, 12, 40], dtype=np.int8)
+        self.assertTrue(np.array_equal(unpack_2to8(data), expected))
+
+    def test_005_to_complex64_int8 (self):
+        data = np.array([[1, -2, 3, -4], [-128, 127, 0, 5]], dtype=np.int8)
+        expected = np.array([[1 - 2j, 3 - 4j], [-128 + 127j, 0 + 5j]], dtype=np.complex64)
+        self.assertTrue(np.array_equal(to_complex64(data), expected))
+        out = np.zeros((2, 6), dtype=np.complex64)
+        to_complex64(data, out=out[:, 1:3], scale=2)
+        self.assertTrue(np.array_equal(out[:, 1:3], expected * 2))
+
+    def test_006_rebin_freq (self):
+        data = np.arange(30, dtype=np.uint8).reshape(3, 10)
+        # 10 channels into 4 bins: edges 0, 2, 5, 7, 10
+        expected = np.array([[0.5, 3, 5.5, 8]], dtype=np.float32) + 10 * np.arange(3)[:, None]
+        result = rebin_freq(data, 4)
+        self.assertEqual(result.dtype, np.float32)
+        self.assertFloatTuplesAlmostEqual(result.ravel(), expected.ravel())
+        out = np.zeros((5, 4), dtype=np.float32)
+        rebin_freq(data, 4, out=out[1:4])
+        self.assertFloatTuplesAlmostEqual(out[1:4].ravel(), expected.ravel())
+        self.assertFloatTuplesAlmostEqual(rebin_freq(data, 5).ravel(), data.reshape(3, 5, 2).mean(axis=2).ravel())
+        self.assertRaises(ValueError, rebin_freq, data, 11)
+
+    def test_007_envelope (self):
+        data = np.array([[3, -1, 4, 1, -5, 9, 2], [0, 1, 2, 3, 4, 5, 6]], dtype=np.float32)
+        # 7 values into 3 columns: edges 0, 2, 4, 7
+        expected = np.array([[[-1, 3], [1, 4], [-5, 9]], [[0, 1], [2, 3], [4, 6]]], dtype=np.float32)
+        self.assertTrue(np.array_equal(envelope(data, 3), expected))
+        out = np.zeros((2, 3, 2), dtype=np.float32)
+        envelope(data.astype(np.complex64).real, 3, out=out)
+        self.assertTrue(np.array_equal(out, expected))
+        self.assertRaises(ValueError, envelope, data, 8)
+
+
+    def test_008_rebin_freq_nan (self):
+        data = np.arange(20, dtype=np.float32).reshape(2, 10)
+        data[0, 2] = np.nan
+        data[1, 5:7] = np.nan
+        # NaN channels are left out of their bin, as with np.nanmean
+        expected = np.array([[0.5, 3, 5.5, 8], [10.5, 13, np.nan, 18]], dtype=np.float32)
+        expected[0, 1] = (3 + 4) / 2.
+        result = rebin_freq(data, 4)
+        self.assertTrue(np.array_equal(np.isnan(result), np.isnan(expected)))
+        valid = ~np.isnan(expected)
+        self.assertFloatTuplesAlmostEqual(result[valid], expected[valid])
+
+if __name__ == '__main__':
+    gr_unittest.run(qa_utils, "qa_utils.xml")
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 
+# Copyright 2019 <+YOU OR YOUR COMPANY+>.
+# 
+# This is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+# 
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this software; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street,
+# Boston, MA 02110-1301, USA.
+# 
+
+
+
+import numpy as np
+import pmt
+from gnuradio import gr
+from filterbank import sigproc_header_from_guppi
+from guppi import GuppiRaw, GuppiRawSequence, channel_subset_header
+from guppi_source import read_stream_tags
+from utils import to_complex64
+
+MAX_FFT_BATCH = 1 << 22  # Max number of complex samples transformed in one FFT call
+
+
+class spectrometer(gr.basic_block):
+    """
+    Turns nchan coarse channels of dual-polarization voltages into
+    filterbank rows of nchan*n_fft float32 channels.
+
+    Every n_fft samples of every channel are Fourier transformed, the
+    power of both polarizations is summed, and n_int such spectra are
+    summed into each row. The fine channels of each coarse channel are in
+    FFT-shifted order, with the center of the coarse channel at n_fft // 2,
+    as sigproc_header_from_guppi expects. The FFTs of all channels and
+    both polarizations are done together, in batches of up to
+    MAX_FFT_BATCH samples.
+
+    Without a filename, the input is the complex64 stream of guppi_source,
+    with an X and a Y polarization port per channel (x0, y0, x1, y1, ...)
+    or with vector_input set, vectors of nchan*2 samples in that order.
+    With a filename, nchan channels from chan are read straight from the
+    GUPPI raw file (the whole scan if multifile is set), the length of
+    whose blocks must be a multiple of n_fft. A partial last row is
+    dropped.
+
+    The first row is tagged with fch1, foff and tsamp (MHz, MHz and
+    seconds) and rx_time, as fb_sink reads them. These come from the file
+    headers, or from the rx_freq or chan_freqs and rx_time tags of the
+    input stream and tbin, the sample time of the input (no tags if 0).
+    """
+    def __init__(self, n_fft, n_int=1, nchan=1, vector_input=0, tbin=0.0,
+                 filename='', chan=-1, multifile=0):
+        if filename:
+            in_sig = None
+        elif vector_input:
+            in_sig = [(np.complex64, nchan * 2)]
+        else:
+            in_sig = [np.complex64, np.complex64] * nchan
+        gr.basic_block.__init__(self,
+            name="spectrometer",
+            in_sig=in_sig,
+            out_sig=[(np.float32, nchan * n_fft)])
+        self.n_fft = int(n_fft)
+        self.n_int = int(n_int)
+        self.nchan = nchan
+        self.vector_input = bool(vector_input)
+        self.tbin = float(tbin)
+        self.set_relative_rate(1.0 / (self.n_fft * self.n_int))
+        self.set_tag_propagation_policy(gr.TPP_DONT)
+        # Spectra summed so far for the next row, and FFT frames per batch
+        self.acc = np.zeros((nchan, self.n_fft), dtype=np.float32)
+        self.n_acc = 0
+        self.batch_frames = max(1, MAX_FFT_BATCH // (2 * nchan * self.n_fft))
+        self.tagged = False
+        self.reader = None
+        if filename:
+            self.reader = GuppiRawSequence(filename) if multifile else GuppiRaw(filename)
+            self.chans = slice(max(chan, 0), max(chan, 0) + nchan)
+            self.nblocks = self.reader.find_n_data_blocks()
+            self.block_idx = 0
+            # The decoded block, as (pol, channel, frame, sample), and its next frame
+            self.block = np.zeros((2, nchan, 0, self.n_fft), dtype=np.complex64)
+            self.frame_idx = 0
+        else:
+            self.frames = np.zeros((2, nchan, self.batch_frames, self.n_fft), dtype=np.complex64)
+
+    def forecast(self, noutput_items, ninput_items_required):
+        for i in range(len(ninput_items_required)):
+            ninput_items_required[i] = (noutput_items * self.n_int - self.n_acc) * self.n_fft
+
+    def general_work(self, input_items, output_items):
+        if self.reader is not None:
+            return self.work_file(output_items[0])
+        out = output_items[0]
+        n_in = min(len(items) for items in input_items)
+        n_frames = min(n_in // self.n_fft, len(out) * self.n_int - self.n_acc)
+        if not self.tagged:
+            self.tag_stream(n_in)
+            self.tagged = True
+        n_out = 0
+        i = 0
+        while i < n_frames:
+            k = min(n_frames - i, self.n_int - self.n_acc, self.batch_frames)
+            self.integrate(self.gather(input_items, i * self.n_fft, k))
+            i += k
+            if self.n_acc == self.n_int:
+                self.output_row(out[n_out])
+                n_out += 1
+        self.consume_each(n_frames * self.n_fft)
+        return n_out
+
+    def work_file(self, out):
+        n_out = 0
+        while n_out < len(out):
+            if self.frame_idx == self.block.shape[2]:
+                if self.read_block() < 0:
+                    return n_out if n_out else -1
+            k = min(self.block.shape[2] - self.frame_idx, self.n_int - self.n_acc, self.batch_frames)
+            self.integrate(self.block[:, :, self.frame_idx:self.frame_idx + k])
+            self.frame_idx += k
+            if self.n_acc == self.n_int:
+                self.output_row(out[n_out])
+                n_out += 1
+        return n_out
+
+    def gather(self, input_items, start, n_frames):
+        """ Copy n_frames FFT frames of input from item start into the (pol, channel, frame, sample) batch """
+        n = n_frames * self.n_fft
+        frames = self.frames[:, :, :n_frames]
+        if self.vector_input:
+            samples = input_items[0][start:start + n].reshape(n_frames, self.n_fft, self.nchan, 2)
+            frames[...] = samples.transpose(3, 2, 0, 1)
+        else:
+            for port, samples in enumerate(input_items):
+                frames[port % 2, port // 2] = samples[start:start + n].reshape(n_frames, self.n_fft)
+        return frames
+
+    def integrate(self, frames):
+        """ Add the power spectra of (pol, channel, frame, sample) frames to the next row """
+        spectra = np.fft.fft(frames, axis=-1)
+        power = spectra.real ** 2
+        power += spectra.imag ** 2
+        self.acc += power.sum(axis=(0, 2))
+        self.n_acc += frames.shape[2]
+
+    def output_row(self, row):
+        """ Write out the summed spectra, FFT-shifted, and start the next row """
+        row = row.reshape(self.nchan, self.n_fft)
+        split = (self.n_fft + 1) // 2
+        row[:, :self.n_fft - split] = self.acc[:, split:]
+        row[:, self.n_fft - split:] = self.acc[:, :split]
+        self.acc[:] = 0
+        self.n_acc = 0
+
+    def read_block(self):
+        """
+        Decode the next block of the file into the block buffer.
+        Returns -1 at the end of the file, 0 otherwise.
+        """
+        if self.block_idx >= self.nblocks:
+            return -1
+        header, dx, dy = self.reader.read_block_channels(self.block_idx, self.chans)
+        n_samples = dx.shape[1]
+        if n_samples % self.n_fft:
+            raise ValueError("spectrometer: blocks of %d samples do not split into %d point FFTs"
+                             % (n_samples, self.n_fft))
+        if self.block.shape[2] != n_samples // self.n_fft:
+            self.block = np.zeros((2, self.nchan, n_samples // self.n_fft, self.n_fft), dtype=np.complex64)
+        to_complex64(dx, out=self.block[0])
+        to_complex64(dy, out=self.block[1])
+        if self.block_idx == 0:
+            self.tag_file(header)
+        self.block_idx += 1
+        self.frame_idx = 0
+        return 0
+
+    def add_header_tags(self, fch1, foff, tsamp, rx_time=None):
+        """ Tag the first row with its frequencies, sample time and start time """
+        offset = self.nitems_written(0)
+        for key, val in (('fch1', fch1), ('foff', foff), ('tsamp', tsamp)):
+            self.add_item_tag(0, offset, pmt.intern(key), pmt.from_double(float(val)))
+        if rx_time is not None:
+            secs, frac = rx_time
+            secs, frac = secs + int(np.floor(frac)), frac - np.floor(frac)
+            self.add_item_tag(0, offset, pmt.intern('rx_time'),
+                              pmt.make_tuple(pmt.from_uint64(int(secs)), pmt.from_double(float(frac))))
+
+    def tag_file(self, header):
+        fb_header = sigproc_header_from_guppi(channel_subset_header(header, self.chans),
+                                              self.n_fft, self.n_int)
+        secs, frac = self.reader.block_start_times()
+        rx_time = None if secs is None else (int(secs[0]), float(frac[0]))
+        self.add_header_tags(fb_header['fch1'], fb_header['foff'], fb_header['tsamp'], rx_time)
+
+    def tag_stream(self, n):
+        """ Tag the first row from the tags of the first n input items """
+        if not self.tbin:
+            return
+        freqs = np.full(self.nchan, np.nan)
+        rx_time = read_stream_tags(self, n, self.nchan, self.vector_input, freqs)
+        if rx_time is not None:
+            # rx_time is the time of sample offset: step back to the first sample
+            secs, frac, offset = rx_time
+            rx_time = (secs, frac - offset * self.tbin)
+        if np.isnan(freqs).any():
+            return
+        chan_bw = (freqs[1] - freqs[0]) / 1e6 if self.nchan > 1 else 1e-6 / self.tbin
+        foff = chan_bw / self.n_fft
+        fch1 = freqs[0] / 1e6 - (self.n_fft // 2) * foff
+        self.add_header_tags(fch1, foff, self.tbin * self.n_fft * self.n_int, rx_time)
@@ -51,10 +51,117 @@ def rebin(d, n_x, n_y=None):
     return d
 
 
+def rebin_freq(d, n_bins, out=None):
+    """ Average (n_time, n_chan) spectra down to n_bins frequency bins in one pass
+
+    Args:
+    d (np.array): data, e.g. a memory-mapped window of filterbank rows
+    n_bins (int): number of frequency bins to average each spectrum into
+    out (np.array): preallocated float32 (n_time, n_bins) array to write into
+
+    Returns:
+    out: rebinned data with shape (n_time, n_bins)
+
+    Notes: channels are split as evenly as possible, so when n_chan is not a
+    multiple of n_bins some bins average one channel more than others and no
+    channels are dropped. NaN channels are left out of their bin's average,
+    as with np.nanmean; a bin of only NaNs is NaN.
+    """
+    n_time, n_chan = d.shape
+    if not 0 < n_bins <= n_chan:
+        raise ValueError("rebin_freq: cannot rebin %d channels into %d bins" % (n_chan, n_bins))
+    if out is None:
+        out = np.empty((n_time, n_bins), dtype=np.float32)
+    edges = np.linspace(0, n_chan, n_bins + 1).astype(np.intp)
+    np.add.reduceat(d, edges[:-1], axis=1, dtype=np.float32, out=out)
+    out /= np.diff(edges).astype(np.float32)
+    nan_rows = np.flatnonzero(np.isnan(out).any(axis=1))
+    if len(nan_rows):
+        # Only rows with NaN channels pay for averaging the valid channels alone
+        rows = np.asarray(d[nan_rows], dtype=np.float32)
+        valid = ~np.isnan(rows)
+        sums = np.add.reduceat(np.where(valid, rows, 0), edges[:-1], axis=1)
+        counts = np.add.reduceat(valid.astype(np.float32), edges[:-1], axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out[nan_rows] = sums / counts
+    return out
+
+
+def envelope(d, n_cols, out=None):
+    """ Decimate data to the min and max of n_cols columns along the last axis
+
+    Args:
+    d (np.array): data, of shape (..., n)
+    n_cols (int): number of columns, e.g. screen pixels, to decimate into
+    out (np.array): preallocated float32 (..., n_cols, 2) array to write into
+
+    Returns:
+    out: (min, max) of each column, with shape d.shape[:-1] + (n_cols, 2)
+
+    Notes: drawn as a line strip through min, max, min, max... the envelope
+    looks the same as the full data at a fraction of the vertices.
+    """
+    n = d.shape[-1]
+    if not 0 < n_cols <= n:
+        raise ValueError("envelope: cannot decimate %d values into %d columns" % (n, n_cols))
+    if out is None:
+        out = np.empty(d.shape[:-1] + (n_cols, 2), dtype=np.float32)
+    edges = np.linspace(0, n, n_cols + 1).astype(np.intp)[:-1]
+    np.minimum.reduceat(d, edges, axis=-1, out=out[..., 0])
+    np.maximum.reduceat(d, edges, axis=-1, out=out[..., 1])
+    return out
+
+
+def complex64_pairs(out):
+    """ Writable float32 view of a complex64 array, with a last axis of (real, imag)
+
+    Unlike out.view('float32'), this works whatever the strides of out are.
+    """
+    return np.lib.stride_tricks.as_strided(out.real, shape=out.shape + (2,),
+                                           strides=out.strides + (out.real.itemsize,))
+
+
+def to_complex64(data, nbit=8, out=None, scale=None):
+    """ Convert interleaved (real, imag) integer samples to complex64 in one pass
+
+    Args:
+        data (np.array): int8 or uint8 data with real and imaginary values
+                         interleaved along the last axis, packed nbit to a value
+        nbit (int): bits per value (8, 4 or 2)
+        out (np.array): preallocated complex64 array to write into; data is
+                        reshaped to match it. Allocated if not given.
+        scale (float): factor to multiply every value by
+
+    Returns:
+        out: complex64 array, of shape data.shape[:-1] + (n_values // 2,) if allocated
+
+    Notes:
+        The output is written through a float32 (real, imag) view, so no
+        intermediate float or complex128 arrays are created.
+    """
+    if nbit == 4:
+        # Each byte is one (real, imag) sample: decode without the int8 step
+        if out is not None:
+            data = data.reshape(out.shape)
+        return unpack_4to_complex64(data, out, scale)
+    if nbit != 8:
+        data = unpack(data.view(np.uint8), nbit)
+    if out is None:
+        out = np.empty(data.shape[:-1] + (data.shape[-1] // 2,), dtype=np.complex64)
+    pairs = complex64_pairs(out)
+    data = data.reshape(pairs.shape)
+    if scale is None:
+        pairs[...] = data
+    else:
+        np.multiply(data, np.float32(scale), out=pairs, casting='unsafe')
+    return out
+
+
 def unpack(data, nbit):
     """upgrade data from nbits to 8bits
 
-    Notes: Pretty sure this function is a little broken!
+    Notes: 4-bit values are signed two's complement, 2-bit codes are mapped
+    to TWO_BIT_LEVELS and 1-bit data is returned as unsigned 0 / 1.
     """
     if nbit > 8:
         raise ValueError("unpack: nbit must be <= 8")
@@ -84,73 +191,99 @@ def unpack_1to8(data):
     return np.unpackbits(data)
 
 
+def _two_bit_lut():
+    """ Lookup table from a packed byte to its four 2-bit levels, MSB first
+
+    Each entry holds the four int8 levels of one byte as a single int32
+    word, so decoding is one gather of 4 bytes per input byte.
+    """
+    codes = np.arange(256, dtype=np.uint8)[:, None]
+    shifts = np.array([6, 4, 2, 0], dtype=np.uint8)
+    levels = TWO_BIT_LEVELS[(codes >> shifts) & 3]
+    return np.ascontiguousarray(levels).view(np.int32).ravel()
+
+
+# 2-bit code to level mapping, from the breakthrough docs:
+# https://github.com/UCBerkeleySETI/breakthrough/blob/master/doc/RAW-File-Format.md
+TWO_BIT_LEVELS = np.array([40, 12, -12, -40], dtype=np.int8)
+TWO_BIT_LUT = _two_bit_lut()
+
+
 def unpack_2to8(data):
-    """ Promote 2-bit unisgned data into 8-bit unsigned data.
+    """ Promote 2-bit unisgned data into 8-bit signed data.
 
     Args:
-        data: Numpy array with dtype == uint8
+        data: Numpy array with dtype == uint8 (or int8)
 
-    Notes:
-        DATA MUST BE LOADED as np.array() with dtype='uint8'.
+    Returns:
+        Numpy int8 array, with the last axis 4x as long as that of data
 
-        This works with some clever shifting and AND / OR operations.
-        Data is LOADED as 8-bit, then promoted to 32-bits:
-        /ABCD EFGH/ (8 bits of data)
-        /0000 0000/0000 0000/0000 0000/ABCD EFGH/ (8 bits of data as a 32-bit word)
+    Notes:
+        Each byte holds four 2-bit codes, most significant first:
+        /ABCD EFGH/ -> [AB, CD, EF, GH]
 
-        Once promoted, we can do some shifting, AND and OR operations:
-        /0000 0000/0000 ABCD/EFGH 0000/0000 0000/ (shifted << 12)
-        /0000 0000/0000 ABCD/EFGH 0000/ABCD EFGH/ (bitwise OR of previous two lines)
-        /0000 0000/0000 ABCD/0000 0000/0000 EFGH/ (bitwise AND with mask 0xF000F)
-        /0000 00AB/CD00 0000/0000 00EF/GH00 0000/ (prev. line shifted << 6)
-        /0000 00AB/CD00 ABCD/0000 00EF/GH00 EFGH/ (bitwise OR of previous two lines)
-        /0000 00AB/0000 00CD/0000 00EF/0000 00GH/ (bitwise AND with 0x3030303)
+        The codes are mapped to values in the range [-40, 40] according to TWO_BIT_LEVELS.
+        Rather than shifting and masking, every byte is decoded in a single
+        gather from the 256-entry TWO_BIT_LUT.
+    """
+    return np.take(TWO_BIT_LUT, data.view(np.uint8)).view(np.int8)
 
-        Then we change the view of the data to interpret it as 4x8 bit:
-        [000000AB, 000000CD, 000000EF, 000000GH]  (change view from 32-bit to 4x8-bit)
 
-        The converted bits are then mapped to values in the range [-40, 40] according to a lookup chart.
-        The mapping is based on specifications in the breakthough docs:
-        https://github.com/UCBerkeleySETI/breakthrough/blob/master/doc/RAW-File-Format.md
+def _four_bit_luts():
+    """ Lookup tables from a packed byte to its two signed 4-bit values, high nibble first
 
+    Returns the values of each byte as a single int16 word (two int8s),
+    and as one complex64 sample with the high nibble as the real part.
     """
-    two_eight_lookup = {0: 40,
-                        1: 12,
-                        2: -12,
-                        3: -40}
-
-    tmp = data.astype(np.uint32)
-    tmp = (tmp | (tmp << 12)) & 0xF000F
-    tmp = (tmp | (tmp << 6)) & 0x3030303
-    tmp = tmp.byteswap()
-    tmp = tmp.view('uint8')
-    mapped = np.array(tmp, dtype=np.int8)
-    for k, v in two_eight_lookup.items():
-        mapped[tmp == k] = v
-    return mapped
+    codes = np.arange(256, dtype=np.uint8)[:, None]
+    nibbles = (codes >> np.array([4, 0], dtype=np.uint8)) & 0xF
+    # Sign-extend the 4-bit two's complement values
+    values = np.where(nibbles >= 8, nibbles.astype(np.int16) - 16, nibbles).astype(np.int8)
+    lut = np.ascontiguousarray(values).view(np.int16).ravel()
+    lut_complex = (values[:, 0] + 1j * values[:, 1]).astype(np.complex64)
+    return lut, lut_complex
+
+
+FOUR_BIT_LUT, FOUR_BIT_COMPLEX_LUT = _four_bit_luts()
 
 
 def unpack_4to8(data):
-    """ Promote 2-bit unisgned data into 8-bit unsigned data.
+    """ Promote 4-bit signed data into 8-bit signed data.
 
     Args:
-        data: Numpy array with dtype == uint8
+        data: Numpy array with dtype == uint8 (or int8)
+
+    Returns:
+        Numpy int8 array, with the last axis 2x as long as that of data
 
     Notes:
-        # The process is this:
-        # ABCDEFGH [Bits of one 4+4-bit value]
-        # 00000000ABCDEFGH [astype(uint16)]
-        # 0000ABCDEFGH0000 [<< 4]
-        # 0000ABCDXXXXEFGH [bitwise 'or' of previous two lines]
-        # 0000111100001111 [0x0F0F]
-        # 0000ABCD0000EFGH [bitwise 'and' of previous two lines]
-        # ABCD0000EFGH0000 [<< 4]
-        # which effectively pads the two 4-bit values with zeros on the right
-        # Note: This technique assumes LSB-first ordering
+        Each byte holds two 4-bit two's complement values, high nibble first:
+        /ABCD EFGH/ -> [ssssABCD, ssssEFGH]  (s: sign bit of the nibble)
+        Every byte is decoded in a single gather from the 256-entry FOUR_BIT_LUT.
     """
+    return np.take(FOUR_BIT_LUT, data.view(np.uint8)).view(np.int8)
+
 
-    tmpdata = data.astype(np.int16)  # np.empty(upshape, dtype=np.int16)
-    tmpdata = (tmpdata | (tmpdata << 4)) & 0x0F0F
-    # tmpdata = tmpdata << 4 # Shift into high bits to avoid needing to sign extend
-    updata = tmpdata.byteswap()
-    return updata.view(data.dtype)
\ No newline at end of file
+def unpack_4to_complex64(data, out=None, scale=None):
+    """ Decode 4+4-bit complex data straight to complex64.
+
+    Args:
+        data: Numpy array with dtype == uint8 (or int8), one (real, imag)
+              sample per byte with the real part in the high nibble
+        out: preallocated complex64 array of the same shape as data
+        scale (float): factor to multiply every value by, folded into the table
+
+    Returns:
+        out: complex64 array of the same shape as data
+    """
+    lut = FOUR_BIT_COMPLEX_LUT
+    if scale is not None:
+        lut = (lut * np.float32(scale)).astype(np.complex64)
+    data = data.view(np.uint8)
+    if out is None:
+        out = np.empty(data.shape, dtype=np.complex64)
+    if out.flags.c_contiguous:
+        np.take(lut, data, out=out, mode='clip')
+    else:
+        out[...] = np.take(lut, data)
+    return out